@@ -1,9 +1,56 @@
-from flask import Flask
+import os
+
+from flask import Flask, abort
+
+from keyvault_config import secrets_from_environment
+from storage import files_from_environment
+from telemetry import RequestTelemetry, telemetry_from_environment
+
 app = Flask(__name__)
 
+# Application Insights telemetry, when APPINSIGHTS_INSTRUMENTATIONKEY (set by
+# azure-devops.py) or TELEMETRY_FILE is present. Calls to Key Vault and the file
+# share are recorded as dependencies.
+telemetry = telemetry_from_environment()
+if telemetry:
+    app.wsgi_app = RequestTelemetry(app.wsgi_app, telemetry)
+
+# Secrets from the service's Key Vault, loaded before gunicorn forks the
+# workers; handlers read them with secrets.get(name)
+secrets = secrets_from_environment(telemetry=telemetry)
+
+HEALTH_CHECK_PATH = '/healthz'
+
+class HealthCheck:
+    # Answers the health check before the request reaches Flask, so probes
+    # from App Service or the load balancer skip every hook and middleware
+    def __init__(self, wsgi_app, path=HEALTH_CHECK_PATH):
+        self.wsgi_app = wsgi_app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '2')])
+            return [b'ok']
+        return self.wsgi_app(environ, start_response)
+
+# Keep this outermost: other WSGI middleware must wrap app.wsgi_app above this line
+app.wsgi_app = HealthCheck(app.wsgi_app)
+
+# The service's Azure Files share, when mounted (FILES_ROOT)
+files = files_from_environment(telemetry=telemetry)
+
 @app.route('/')
 def hello_world():
     return 'Hello, World!'
 
+@app.route('/files/<path:name>')
+def share_file(name):
+    # Read-only: the app writes to the share through files.write, not over HTTP
+    if files is None:
+        abort(404)
+    return files.send(name)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
+    # Development server - production runs under gunicorn (see gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
@@ -0,0 +1,10 @@
+#!/bin/sh
+# Start the app in the mode chosen by APP_MODE: "production" serves it with
+# gunicorn, anything else runs Flask's development server
+set -e
+
+if [ "$APP_MODE" = "production" ]; then
+    exec gunicorn --config gunicorn.conf.py app:app
+else
+    exec python ./app.py
+fi
@@ -0,0 +1,42 @@
+# gunicorn settings for the production serving mode (APP_MODE=production).
+# Every setting can be overridden through the environment.
+
+import os
+
+def available_cores():
+    # App Service plans limit the container's CPUs, so count the ones we may use
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# (2 x cores) + 1 processes, each with a few threads so slow I/O in one
+# request doesn't hold up the rest: 3 workers on a B1, 5 on a P1v3
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * available_cores() + 1))
+# The app is loaded after this file is read, so it can size per-worker shares
+# of anything limited overall (the file cache) by the number of workers
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Load the app once in the master so workers share it (and anything it loads
+# at start-up) copy-on-write
+preload_app = True
+
+# Longer than the App Service front end keeps idle connections to the
+# container, so it is the front end, not gunicorn, that closes them
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 75))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+# On SIGHUP or shutdown, give in-flight requests this long to finish
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Recycle workers now and then to bound memory growth, staggered so they
+# don't all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
@@ -0,0 +1,107 @@
+# Secrets from the service's Key Vault, loaded once at start-up and kept fresh
+# in the background, so request handlers never wait on Key Vault.
+#
+# Under gunicorn the app is preloaded (see gunicorn.conf.py), so the secrets
+# are fetched once in the master and every worker starts with a copy; each
+# worker then refreshes its own copy before the entries expire. Connections
+# must not be shared across the fork, so each process builds its own client.
+
+import concurrent.futures
+import os
+import threading
+import time
+import urllib.parse
+
+from telemetry import dependency
+
+DEFAULT_SECRET_NAMES = ('azureStorageAccountName', 'azureStorageAccountKey')
+
+class SecretCache:
+    def __init__(self, client_factory, names, ttl=3600, refresh_margin=300, concurrency=8, telemetry=None):
+        # client_factory() returns a SecretClient
+        self.client_factory = client_factory
+        self.telemetry = telemetry
+        self.names = tuple(names)
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl / 2)
+        self.concurrency = concurrency
+        self.refresh_failures = 0
+        self._values = {}
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._client_pid = None
+
+    def _secret_client(self):
+        # A client made before a fork would share its pooled connections with
+        # the parent, so make a new one in each process
+        if self._client_pid != os.getpid():
+            with self._lock:
+                if self._client_pid != os.getpid():
+                    self._client = self.client_factory()
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def _fetch(self, name):
+        secret_client = self._secret_client()
+        with dependency(self.telemetry, f'GET /secrets/{name}', 'Azure Key Vault',
+                urllib.parse.urlsplit(secret_client.vault_url).netloc):
+            return name, secret_client.get_secret(name).value
+
+    def load(self):
+        # Fetch every secret at once; raises if any can't be read
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            values = dict(executor.map(self._fetch, self.names))
+        with self._lock:
+            self._values = values
+            self._expires = time.time() + self.ttl
+        return self
+
+    def _ensure_refreshing(self):
+        # Threads don't survive gunicorn's fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._refresh_loop, name='secret-refresh', daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(max(1, self._expires - self.refresh_margin - time.time()))
+            try:
+                self.load()
+            except Exception:
+                # Keep serving the values we have and try again shortly
+                self.refresh_failures += 1
+                self._expires = time.time() + self.refresh_margin + 30
+
+    def get(self, name, default=None):
+        self._ensure_refreshing()
+        return self._values.get(name, default)
+
+    def __getitem__(self, name):
+        self._ensure_refreshing()
+        return self._values[name]
+
+def secrets_from_environment(environ=os.environ, telemetry=None):
+    # KEY_VAULT_URL is set on each app by azure-devops.py; SECRET_NAMES lists
+    # the secrets to load (comma separated)
+    vault_url = environ.get('KEY_VAULT_URL')
+    if not vault_url:
+        return None
+
+    from azure.identity import DefaultAzureCredential
+    from azure.keyvault.secrets import SecretClient
+
+    # In App Service this resolves to the app's managed identity. Each process
+    # keeps one credential and client, so the token is cached across refreshes.
+    def secret_client():
+        return SecretClient(vault_url=vault_url, credential=DefaultAzureCredential())
+
+    names = [name.strip() for name in environ.get('SECRET_NAMES', ','.join(DEFAULT_SECRET_NAMES)).split(',') if name.strip()]
+    secrets = SecretCache(secret_client, names, ttl=float(environ.get('SECRET_TTL', 3600))).load()
+    # Only the workers' refreshes are recorded: telemetry queued by the initial
+    # load in the gunicorn master would be copied into, and sent by, every worker
+    secrets.telemetry = telemetry
+    return secrets
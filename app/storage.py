@@ -0,0 +1,216 @@
+# Files on the service's Azure Files share, mounted into the container.
+#
+# Reads go through a local read-through cache, bounded by size with least-
+# recently-used eviction, so hot files don't cost an SMB round-trip per
+# request. Reads and writes are streamed in chunks rather than buffered whole.
+# For tests and local runs the "share" can be any plain directory.
+#
+# Under gunicorn each worker keeps its own cache, in a subdirectory of the
+# cache directory named by its pid, and FILES_CACHE_BYTES is split between the
+# workers so the limit holds for them all together. Directories left by workers
+# that have exited (gunicorn recycles them, see max_requests) are deleted by the
+# next process to start caching.
+
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from flask import abort, send_file
+from werkzeug.security import safe_join
+
+from telemetry import dependency
+
+CHUNK_SIZE = 1024 * 1024
+
+class FileStore:
+    # A directory - in App Service, the mount point of the Azure Files share
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, name):
+        path = safe_join(self.root, name)
+        if path is None:
+            raise ValueError(f"'{name}' is outside the file store")
+        return path
+
+    def stat(self, name):
+        # (size, mtime in ns) identifies a version of the file
+        stat = os.stat(self.path(name))
+        return stat.st_size, stat.st_mtime_ns
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def write(self, name, stream, chunk_size=CHUNK_SIZE):
+        # Stream to a temporary file next to the target and rename it into
+        # place, so readers never see a partly written file
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            try:
+                shutil.copyfileobj(stream, f, chunk_size)
+            except BaseException:
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+        return self.stat(name)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class CachedFileStore:
+    def __init__(self, store, cache_dir, max_bytes, revalidate_after=30, chunk_size=CHUNK_SIZE, processes=1,
+                 telemetry=None):
+        self.store = store
+        self.telemetry = telemetry
+        self.cache_dir = cache_dir
+        # max_bytes is for all the processes sharing cache_dir together
+        self.max_bytes = max_bytes // max(1, processes)
+        self.revalidate_after = revalidate_after
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        # name -> (version, local path, time last checked against the share),
+        # least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._process_dir = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _directory(self):
+        # This process's cache directory. The index of cached files belongs to
+        # one process, so a process forked from one that had cached anything
+        # starts again with an empty directory of its own.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._entries.clear()
+                    self._bytes = 0
+                    for name in os.listdir(self.cache_dir):
+                        if name.isdigit() and not process_alive(int(name)):
+                            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                    path = os.path.join(self.cache_dir, str(os.getpid()))
+                    # A directory with our pid is from a process that has gone
+                    shutil.rmtree(path, ignore_errors=True)
+                    os.makedirs(path)
+                    self._process_dir = path
+                    self._pid = os.getpid()
+        return self._process_dir
+
+    def _evict(self, name):
+        version, path, _ = self._entries.pop(name)
+        self._bytes -= version[0]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _version(self, name):
+        # The cached version if it was checked recently, else ask the share
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and time.monotonic() - entry[2] < self.revalidate_after:
+                self._entries.move_to_end(name)
+                return entry[0]
+        return self.store.stat(name)
+
+    def fetch(self, name):
+        # Local path and version of the file, copying it from the share if the
+        # cache doesn't already hold this version
+        directory = self._directory()
+        version = self._version(name)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry[0] == version:
+                self._entries[name] = (version, entry[1], time.monotonic())
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return entry[1], version
+            self.misses += 1
+
+        if version[0] > self.max_bytes:
+            # Too big to cache - serve straight from the share
+            return self.store.path(name), version
+
+        # Each miss copies to a file of its own, so requests missing on the same
+        # file at once don't overwrite (or evict) each other's copy
+        with dependency(self.telemetry, f'read {name}', 'Azure Files', self.store.root), \
+                self.store.open(name) as source, tempfile.NamedTemporaryFile(dir=directory,
+                prefix=os.path.basename(name) + '.', delete=False) as f:
+            try:
+                shutil.copyfileobj(source, f, self.chunk_size)
+            except BaseException:
+                os.remove(f.name)
+                raise
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry[0] == version:
+                # Another request cached this version first - use its copy
+                os.remove(f.name)
+                self._entries.move_to_end(name)
+                return entry[1], version
+            if entry:
+                self._evict(name)
+            self._entries[name] = (version, f.name, time.monotonic())
+            self._bytes += version[0]
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._evict(next(iter(self._entries)))
+        return f.name, version
+
+    def forget(self, name, path):
+        # Drop the entry for name if it still points at path
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry[1] == path:
+                self._evict(name)
+
+    def write(self, name, stream):
+        version = self.store.write(name, stream, self.chunk_size)
+        with self._lock:
+            if name in self._entries:
+                self._evict(name)
+        return version
+
+    def send(self, name, **kwargs):
+        # A Flask response for the file. send_file handles conditional and
+        # Range requests; the ETag identifies the version on the share, not the
+        # cached copy
+        for attempt in range(2):
+            path = None
+            try:
+                path, (size, mtime) = self.fetch(name)
+                # send_file opens the file here, so evicting it afterwards is safe
+                return send_file(path, etag=f"{size:x}-{mtime:x}", last_modified=mtime / 1e9,
+                    download_name=os.path.basename(name), conditional=True, **kwargs)
+            except FileNotFoundError:
+                # Gone from the share, or the cached copy was evicted between
+                # fetch and send_file - drop the entry and look again once
+                if attempt:
+                    abort(404)
+                self.forget(name, path)
+            except (ValueError, IsADirectoryError):
+                abort(404)
+
+def files_from_environment(environ=os.environ, telemetry=None):
+    # FILES_ROOT is where the share is mounted (set by azure-devops.py)
+    root = environ.get('FILES_ROOT')
+    if not root:
+        return None
+    cache_dir = environ.get('FILES_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'files-cache'))
+    max_bytes = int(environ.get('FILES_CACHE_BYTES', 256 * 1024 * 1024))
+    # gunicorn.conf.py exports the number of workers sharing the cache
+    return CachedFileStore(FileStore(root), cache_dir, max_bytes,
+        revalidate_after=float(environ.get('FILES_REVALIDATE_SECONDS', 30)),
+        processes=int(environ.get('WEB_CONCURRENCY', 1)), telemetry=telemetry)
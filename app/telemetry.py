@@ -0,0 +1,269 @@
+# Request and dependency telemetry for Application Insights.
+#
+# Telemetry is recorded on the request path only as far as putting an item on a
+# bounded in-memory queue; a background thread in each worker process sends it
+# in batches. If the queue is full the item is dropped rather than making the
+# request wait, and sampling can cut the volume further.
+
+import atexit
+import contextlib
+import datetime
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+import uuid
+
+DEFAULT_ENDPOINT = 'https://dc.services.visualstudio.com/v2/track'
+
+def format_duration(seconds):
+    # Application Insights durations are d.hh:mm:ss.ffffff
+    days, remainder = divmod(seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f'{int(days)}.{int(hours):02}:{int(minutes):02}:{seconds:09.6f}'
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+class HttpSender:
+    # Posts batches of envelopes to the Application Insights ingestion endpoint,
+    # or to a local stand-in for it
+    def __init__(self, endpoint=DEFAULT_ENDPOINT, timeout=10):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def send(self, envelopes):
+        request = urllib.request.Request(self.endpoint, data=json.dumps(envelopes).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+class FileSender:
+    # Appends envelopes to a JSON-lines file - for local runs and tests
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, envelopes):
+        with self._lock, open(self.path, 'a') as f:
+            for envelope in envelopes:
+                f.write(json.dumps(envelope) + '\n')
+
+class Telemetry:
+    def __init__(self, instrumentation_key, sender, sample_rate=1.0, max_queue=10000,
+                 batch_size=500, flush_interval=5.0, role_name=None):
+        self.instrumentation_key = instrumentation_key
+        self.sender = sender
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.role_name = role_name
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        atexit.register(self.flush)
+
+    def _ensure_started(self):
+        # gunicorn preloads the app before forking, and threads don't survive a
+        # fork, so each worker starts its own exporter on first use
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='telemetry-exporter', daemon=True)
+                    self._thread.start()
+
+    def _envelope(self, name, base_type, base_data, operation_id):
+        tags = {'ai.operation.id': operation_id}
+        if self.role_name:
+            tags['ai.cloud.role'] = self.role_name
+        return {
+            'name': f'Microsoft.ApplicationInsights.{name}',
+            'time': utc_now(),
+            'iKey': self.instrumentation_key,
+            'tags': tags,
+            'data': {'baseType': base_type, 'baseData': dict(ver=2, **base_data)}
+        }
+
+    def enqueue(self, envelope):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(envelope)
+        except queue.Full:
+            self.dropped += 1
+
+    def sampled(self):
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    @property
+    def operation_id(self):
+        # The id of the request being handled on this thread, if any
+        return getattr(self._local, 'operation_id', None)
+
+    def track_request(self, operation_id, name, url, started, duration, response_code):
+        self.enqueue(self._envelope('Request', 'RequestData', {
+            'id': operation_id,
+            'name': name,
+            'url': url,
+            'startTime': started,
+            'duration': format_duration(duration),
+            'responseCode': str(response_code),
+            'success': response_code < 400
+        }, operation_id))
+
+    def track_dependency(self, name, dependency_type, target, duration, success, data=None, result_code=None):
+        operation_id = self.operation_id
+        if operation_id is None and not self.sampled():
+            return
+        self.enqueue(self._envelope('RemoteDependency', 'RemoteDependencyData', {
+            'id': uuid.uuid4().hex[:16],
+            'name': name,
+            'type': dependency_type,
+            'target': target,
+            'data': data or name,
+            'duration': format_duration(duration),
+            'resultCode': str(result_code) if result_code is not None else '',
+            'success': success
+        }, operation_id or uuid.uuid4().hex))
+
+    @contextlib.contextmanager
+    def dependency(self, name, dependency_type='HTTP', target=None, data=None):
+        # Time a call the app makes to something else:
+        #   with telemetry.dependency('GET /secrets', 'HTTP', 'vault.azure.net'):
+        if getattr(self._local, 'sampled_out', False):
+            yield
+            return
+        started = time.perf_counter()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.track_dependency(name, dependency_type, target, time.perf_counter() - started, success, data)
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _send(self, batch):
+        try:
+            self.sender.send(batch)
+            self.sent += len(batch)
+        except Exception:
+            # Telemetry must never take the app down; count the loss and move on
+            self.failed += len(batch)
+
+    def _run(self):
+        while True:
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._send(batch)
+
+    def flush(self):
+        # Send whatever is queued now, e.g. at exit
+        while True:
+            batch = self._take_batch(0)
+            if not batch:
+                return
+            self._send(batch)
+
+def dependency(telemetry, name, dependency_type='HTTP', target=None, data=None):
+    # telemetry.dependency(...), or nothing when telemetry is off
+    if telemetry is None:
+        return contextlib.nullcontext()
+    return telemetry.dependency(name, dependency_type, target, data)
+
+class ClosingIterator:
+    # Passes a WSGI response body through, calling on_close once the server
+    # has finished sending it, so streamed responses aren't buffered
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.on_close()
+
+class RequestTelemetry:
+    # WSGI middleware recording a Request item for each (sampled) request
+    def __init__(self, wsgi_app, telemetry):
+        self.wsgi_app = wsgi_app
+        self.telemetry = telemetry
+
+    def __call__(self, environ, start_response):
+        telemetry = self.telemetry
+        if not telemetry.sampled():
+            telemetry._local.sampled_out = True
+            try:
+                return self.wsgi_app(environ, start_response)
+            finally:
+                telemetry._local.sampled_out = False
+
+        operation_id = uuid.uuid4().hex
+        status = [500]
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[0] = int(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        started_at = utc_now()
+        started = time.perf_counter()
+
+        def record():
+            path = environ.get('PATH_INFO', '/')
+            query = environ.get('QUERY_STRING')
+            url = f"{environ.get('wsgi.url_scheme', 'http')}://{environ.get('HTTP_HOST', '')}{path}{'?' + query if query else ''}"
+            telemetry.track_request(operation_id, f"{environ.get('REQUEST_METHOD', 'GET')} {path}", url,
+                started_at, time.perf_counter() - started, status[0])
+
+        telemetry._local.operation_id = operation_id
+        try:
+            response = self.wsgi_app(environ, recording_start_response)
+        except Exception:
+            record()
+            raise
+        finally:
+            telemetry._local.operation_id = None
+        return ClosingIterator(response, record)
+
+def telemetry_from_environment(environ=os.environ):
+    # TELEMETRY_FILE writes telemetry to a local file instead of Application
+    # Insights; APPINSIGHTS_ENDPOINT points the sender at a stand-in server
+    instrumentation_key = environ.get('APPINSIGHTS_INSTRUMENTATIONKEY')
+    telemetry_file = environ.get('TELEMETRY_FILE')
+    if telemetry_file:
+        sender = FileSender(telemetry_file)
+    elif instrumentation_key:
+        sender = HttpSender(environ.get('APPINSIGHTS_ENDPOINT', DEFAULT_ENDPOINT))
+    else:
+        return None
+    return Telemetry(
+        instrumentation_key or 'local',
+        sender,
+        sample_rate=float(environ.get('TELEMETRY_SAMPLE_RATE', 1.0)),
+        max_queue=int(environ.get('TELEMETRY_MAX_QUEUE', 10000)),
+        batch_size=int(environ.get('TELEMETRY_BATCH_SIZE', 500)),
+        flush_interval=float(environ.get('TELEMETRY_FLUSH_INTERVAL', 5.0)),
+        role_name=environ.get('WEBSITE_SITE_NAME')
+    )
@@ -1,20 +1,31 @@
+import collections.abc
+import concurrent.futures
+import contextlib
+import dataclasses
 import enum
+import functools
+import glob
+import hashlib
+import itertools
+import json
 import os
+import re
+import shlex
+import string
 import subprocess
 import tempfile
 import sys
+import threading
+import time
+import types
 
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.resource import SubscriptionClient
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.storage.blob import BlobServiceClient
-from azure.core.exceptions import ClientAuthenticationError, ResourceExistsError
+from azure.core.exceptions import AzureError, ClientAuthenticationError, ResourceExistsError, ResourceNotFoundError
+from azure.core.pipeline.transport import HttpTransport, RequestsTransport
 
-import pulumi_azure
-from pulumi.automation import LocalWorkspace, LocalWorkspaceOptions, Stack, ProjectSettings, select_stack
-
-import openpyxl
+# The heavy SDKs - pulumi_azure, pulumi.automation, azure.identity, azure.mgmt.*,
+# azure.storage.blob and openpyxl - are imported by the functions that use them,
+# so --help and other lightweight commands don't pay seconds of import time.
+# dev-scripts/import-benchmark.py guards this.
 
 class ResourceTypes(enum.Enum):
     APP_SERVICE_PLAN = "app_service_plan"
@@ -41,13 +52,225 @@ defaultTemplates = {
     ResourceTypes.KEY_VAULT_ACCESS_POLICY: "{Subscription}-{Service}-{App}"
 }
 
-# Function to convert rows to dictionaries based on the header row
-def rows_to_dicts(sheet):
-    headers = [cell for cell in next(sheet.iter_rows(min_row=1, max_row=1, values_only=True))]
-    return [
-        {headers[i]: cell for i, cell in enumerate(row)}
-            for row in sheet.iter_rows(min_row=2, values_only=True)
-    ]
+class PhaseProfiler:
+    # Records wall time and Azure HTTP traffic for each phase of a run. Phases
+    # nest per thread; it does nothing until enabled (--profile).
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.started = time.time()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name, **attributes):
+        if not self.enabled:
+            yield None
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        span = {
+            "id": next(self._ids),
+            "parent": stack[-1]["id"] if stack else None,
+            "name": name,
+            "thread": threading.current_thread().name,
+            "attributes": attributes,
+            "start": time.time()
+        }
+        http_before = get_client_pool().http_stats()
+        started = time.perf_counter()
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = str(e)
+            raise
+        finally:
+            stack.pop()
+            span["seconds"] = time.perf_counter() - started
+            # HTTP traffic is process-wide, so phases running in parallel share it
+            span["http"] = {}
+            for client_name, http in get_client_pool().http_stats().items():
+                before = http_before.get(client_name, {})
+                delta = {key: value - before.get(key, 0) for key, value in http.items()}
+                if delta["requests"]:
+                    span["http"][client_name] = delta
+            with self._lock:
+                self.spans.append(span)
+
+    def report(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        return {
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "phases": spans,
+            "http": get_client_pool().http_stats(),
+            "clients": get_client_pool().stats()
+        }
+
+    def otlp_report(self):
+        # The same spans as an OTLP/JSON trace, for OpenTelemetry tooling
+        trace_id = os.urandom(16).hex()
+        def attribute(key, value):
+            return {"key": key, "value": {"intValue": value} if isinstance(value, int) else {"stringValue": str(value)}}
+        spans = []
+        for span in self.report()["phases"]:
+            attributes = [attribute(key, value) for key, value in span["attributes"].items()]
+            attributes.append(attribute("thread.name", span["thread"]))
+            for client_name, http in span["http"].items():
+                attributes.extend(attribute(f"azure.{client_name}.{key}", value) for key, value in http.items())
+            spans.append({
+                "traceId": trace_id,
+                "spanId": f"{span['id']:016x}",
+                "parentSpanId": f"{span['parent']:016x}" if span["parent"] else "",
+                "name": span["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(int(span["start"] * 1e9)),
+                "endTimeUnixNano": str(int((span["start"] + span["seconds"]) * 1e9)),
+                "attributes": attributes,
+                "status": {"code": 2, "message": span["error"]} if "error" in span else {}
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", "azure-devops")]},
+            "scopeSpans": [{"scope": {"name": "azure-devops"}, "spans": spans}]
+        }]}
+
+    def write(self, file_path, format="json"):
+        report = self.otlp_report() if format == "otlp" else self.report()
+        with open(file_path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"..Timing report written to {file_path}")
+
+profiler = PhaseProfiler()
+
+def profiled(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class DeploymentStatus(enum.Enum):
+    RUNNING = "running"
+    STOPPED = "stopped"
+
+class Deployment(collections.abc.Mapping):
+    # One Deployments row, defaulted and typed as the sheet is read. It still
+    # reads like the row's dict - deployment['Service'], deployment.get('App') -
+    # so name templates can use any column, including ones not listed here.
+    __slots__ = ("defines", "resource_group", "service", "app", "region", "sku", "files_quota", "status",
+                 "subscription", "extra")
+
+    # Sheet column -> attribute
+    COLUMNS = {
+        "Defines": "defines",
+        "Resource Group": "resource_group",
+        "Service": "service",
+        "App": "app",
+        "Region": "region",
+        "sku": "sku",
+        "Files quota": "files_quota",
+        "Status": "status",
+        "Subscription": "subscription",
+    }
+
+    def __init__(self, defines, resource_group, service, app, region, sku, files_quota, status, subscription, extra):
+        self.defines = defines
+        self.resource_group = resource_group
+        self.service = service
+        self.app = app
+        self.region = region
+        self.sku = sku
+        self.files_quota = files_quota
+        self.status = status
+        self.subscription = subscription
+        self.extra = extra
+
+    def __getitem__(self, column):
+        attribute = self.COLUMNS.get(column)
+        if attribute is None:
+            return self.extra[column]
+        value = getattr(self, attribute)
+        return value.value if isinstance(value, enum.Enum) else value
+
+    def __iter__(self):
+        yield from self.COLUMNS
+        yield from self.extra
+
+    def __len__(self):
+        return len(self.COLUMNS) + len(self.extra)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# Deployments columns that must be filled in, and the defaults for the rest
+REQUIRED_DEPLOYMENT_COLUMNS = ("Defines", "Resource Group", "Service")
+DEPLOYMENT_DEFAULTS = {"sku": "B1", "Region": "uksouth", "Files quota": 50, "Status": DeploymentStatus.RUNNING}
+
+def cell_text(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip() or None
+
+def read_deployments(sheet, subscription_slug):
+    # Read the Deployments sheet in one pass straight into Deployment records,
+    # applying defaults and types as each row is read. Every problem found is
+    # reported at once. Empty rows are skipped.
+    rows = sheet.iter_rows(values_only=True)
+    headers = [cell_text(header) for header in next(rows, ())]
+    known = {header: i for i, header in enumerate(headers) if header in Deployment.COLUMNS}
+    extra_columns = [(header, i) for i, header in enumerate(headers) if header and header not in Deployment.COLUMNS]
+    statuses = {status.value: status for status in DeploymentStatus}
+
+    deployments = []
+    errors = []
+    for row in rows:
+        if all(value is None for value in row):
+            continue
+        i = len(deployments)
+        values = {header: cell_text(row[index]) if index < len(row) else None for header, index in known.items()}
+
+        required = REQUIRED_DEPLOYMENT_COLUMNS
+        if (values.get("Defines") or "").lower() == "app":
+            required += ("App",)
+        for column in required:
+            if not values.get(column):
+                errors.append(f"'{column}' is missing from row {i+1} of the deployments worksheet")
+
+        files_quota = DEPLOYMENT_DEFAULTS["Files quota"]
+        if values.get("Files quota"):
+            try:
+                files_quota = int(values["Files quota"])
+            except ValueError:
+                errors.append(f"Row {i+1}: 'Files quota' must be a whole number of GiB, not '{values['Files quota']}'")
+
+        status = DEPLOYMENT_DEFAULTS["Status"]
+        if values.get("Status"):
+            status = statuses.get(values["Status"].lower())
+            if status is None:
+                errors.append(f"Row {i+1}: 'Status' must be one of {', '.join(statuses)}, not '{values['Status']}'")
+
+        deployments.append(Deployment(
+            defines=(values.get("Defines") or "").lower(),
+            resource_group=values.get("Resource Group"),
+            service=(values.get("Service") or "").lower(),
+            app=values.get("App"),
+            region=(values.get("Region") or DEPLOYMENT_DEFAULTS["Region"]).lower(),
+            sku=values.get("sku") or DEPLOYMENT_DEFAULTS["sku"],
+            files_quota=files_quota,
+            status=status,
+            subscription=subscription_slug,
+            extra={header: row[index] for header, index in extra_columns if index < len(row)}
+        ))
+
+    if errors:
+        raise ValueError("Invalid rows in the deployments worksheet:\n  " + "\n  ".join(errors))
+    return tuple(deployments)
 
 def worksheet_to_dict(worksheet):
     data_dict = {}
@@ -57,42 +280,333 @@ def worksheet_to_dict(worksheet):
             data_dict[key] = value
     return data_dict
 
-def validate_azure (subscription_name):
-    # Authenticate with Azure
+def templates_from_dict(data):
+    # Templates worksheet rows are "<resource type>, <template>" pairs, keyed
+    # by the ResourceTypes value (e.g. "storage_account")
+    templates = {}
+    for key, value in data.items():
+        try:
+            templates[ResourceTypes(key.lower())] = value
+        except ValueError:
+            raise ValueError(f"Unknown resource type '{key}' in Templates worksheet")
+    return templates
+
+# Parsed, read-only view of a configuration workbook. It is loaded once per run
+# and handed to every stage (validation, bootstrap, the Pulumi program) in place
+# of the file name so the workbook is only ever parsed once.
+@dataclasses.dataclass(frozen=True)
+class WorkbookConfiguration:
+    file_name: str
+    stack_name: str
+    digest: str
+    config: types.MappingProxyType
+    templates: types.MappingProxyType
+    deployments: tuple
+
+# Workbooks already parsed by this process: path -> ((mtime, size), configuration)
+_workbook_cache = {}
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@profiled("load_configuration")
+def load_configuration(config_file):
+    path = os.path.abspath(config_file)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _workbook_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    # The file was touched - only re-parse if the content really changed
+    digest = file_digest(path)
+    if cached and cached[1].digest == digest:
+        _workbook_cache[path] = (signature, cached[1])
+        return cached[1]
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        if 'Configuration' not in workbook.sheetnames:
+            raise ValueError(f"Configuration worksheet not found in {config_file}")
+        if 'Deployments' not in workbook.sheetnames:
+            raise ValueError(f"Deployments worksheet not found in {config_file}")
+        config = worksheet_to_dict(workbook['Configuration'])
+        templates = {}
+        templates.update(defaultTemplates)
+        if 'Templates' in workbook.sheetnames:
+            templates.update(templates_from_dict(worksheet_to_dict(workbook['Templates'])))
+        # validate_configuration reports a missing slug
+        deployments = read_deployments(workbook['Deployments'], (config.get('Subscription slug') or "").lower())
+    finally:
+        workbook.close()
+
+    configuration = WorkbookConfiguration(
+        file_name=path,
+        stack_name=os.path.splitext(os.path.basename(path))[0],
+        digest=digest,
+        config=types.MappingProxyType(config),
+        templates=types.MappingProxyType(templates),
+        deployments=deployments
+    )
+    _workbook_cache[path] = (signature, configuration)
+    return configuration
+
+class CachingCredential:
+    # Wraps the run's single credential so every client shares one token cache.
+    # Tokens are reused until shortly before they expire.
+    REFRESH_MARGIN = 300
+
+    def __init__(self, credential, counters):
+        self._credential = credential
+        self._counters = counters
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        key = (scopes, kwargs.get("tenant_id"), kwargs.get("claims"))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token and token.expires_on - self.REFRESH_MARGIN > time.time():
+                return token
+            token = self._credential.get_token(*scopes, **kwargs)
+            self._counters["tokens_fetched"] += 1
+            self._tokens[key] = token
+            return token
+
+    def close(self):
+        close = getattr(self._credential, "close", None)
+        if close:
+            close()
+
+class SharedTransport(HttpTransport):
+    # Hands every client the same underlying transport (and so the same HTTP
+    # connection pool). Clients closing their pipeline must not close it, so
+    # only AzureClientPool.close() shuts the real transport down.
+    def __init__(self, transport, pool, client_name):
+        self._transport = transport
+        self._pool = pool
+        self._client_name = client_name
+
+    def __enter__(self):
+        self._transport.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def open(self):
+        self._transport.open()
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        response = self._transport.send(request, **kwargs)
+        # Content-Length rather than the body, so streamed downloads aren't read here
+        self._pool.record_request(self._client_name,
+            int(request.headers.get("Content-Length") or 0),
+            int(response.headers.get("Content-Length") or 0))
+        return response
+
+class AzureClientPool:
+    # Process-wide factory for Azure management and storage clients. Clients are
+    # keyed by (subscription or account, client type) and all share one credential,
+    # token cache and HTTP transport. Pass a transport (e.g. a mock returning canned
+    # responses) and/or credential to run against something other than Azure.
+    def __init__(self, credential=None, transport=None):
+        self.counters = {"tokens_fetched": 0, "requests_sent": 0}
+        self._credential = credential
+        self._transport = transport or RequestsTransport()
+        self._clients = {}
+        self._http = {}
+        self._lock = threading.RLock()
+
+    @property
+    def credential(self):
+        with self._lock:
+            if not isinstance(self._credential, CachingCredential):
+                from azure.identity import DefaultAzureCredential
+                self._credential = CachingCredential(self._credential or DefaultAzureCredential(), self.counters)
+            return self._credential
+
+    def client(self, client_type, key, factory):
+        with self._lock:
+            client = self._clients.get((key, client_type))
+            if client is None:
+                client = factory(transport=SharedTransport(self._transport, self, client_type.__name__))
+                self._clients[(key, client_type)] = client
+            return client
+
+    def subscription_client(self):
+        from azure.mgmt.resource import SubscriptionClient
+        return self.client(SubscriptionClient, None,
+            lambda **kwargs: SubscriptionClient(self.credential, **kwargs))
+
+    def resource_client(self, subscription_id):
+        from azure.mgmt.resource import ResourceManagementClient
+        return self.client(ResourceManagementClient, subscription_id,
+            lambda **kwargs: ResourceManagementClient(self.credential, subscription_id, **kwargs))
+
+    def storage_client(self, subscription_id):
+        from azure.mgmt.storage import StorageManagementClient
+        return self.client(StorageManagementClient, subscription_id,
+            lambda **kwargs: StorageManagementClient(self.credential, subscription_id, **kwargs))
+
+    def blob_service_client(self, account_url, account_key, **config):
+        # config is client configuration such as max_block_size; clients with
+        # different configuration are pooled separately
+        from azure.storage.blob import BlobServiceClient
+        return self.client(BlobServiceClient, (account_url, *sorted(config.items())),
+            lambda **kwargs: BlobServiceClient(account_url=account_url, credential=account_key, **config, **kwargs))
+
+    def record_request(self, client_name, bytes_sent, bytes_received):
+        with self._lock:
+            self.counters["requests_sent"] += 1
+            http = self._http.setdefault(client_name, {"requests": 0, "bytes_sent": 0, "bytes_received": 0})
+            http["requests"] += 1
+            http["bytes_sent"] += bytes_sent
+            http["bytes_received"] += bytes_received
+
+    def http_stats(self):
+        # Requests and bytes transferred so far, per client type
+        with self._lock:
+            return {client_name: dict(http) for client_name, http in self._http.items()}
+
+    def connections_opened(self):
+        # urllib3 counts every new connection each host pool has had to open
+        session = getattr(self._transport, "session", None)
+        opened = 0
+        if session is not None:
+            for adapter in session.adapters.values():
+                pools = adapter.poolmanager.pools
+                opened += sum(pools[key].num_connections for key in pools.keys())
+        return opened
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, clients=len(self._clients), connections_opened=self.connections_opened())
+
+    def close(self):
+        with self._lock:
+            self._clients.clear()
+            self._transport.close()
+            if isinstance(self._credential, CachingCredential):
+                self._credential.close()
+
+_client_pool = None
+_client_pool_lock = threading.Lock()
+
+def get_client_pool():
+    global _client_pool
+    with _client_pool_lock:
+        if _client_pool is None:
+            _client_pool = AzureClientPool()
+        return _client_pool
+
+def set_client_pool(pool):
+    # Replace the process-wide pool, e.g. with stubs for a dry run, returning
+    # the one it replaces so it can be put back
+    global _client_pool
+    with _client_pool_lock:
+        previous, _client_pool = _client_pool, pool
+        return previous
+
+# The subset of an Azure subscription the deployment needs, whether it came
+# from the subscription cache or from ARM
+@dataclasses.dataclass(frozen=True)
+class SubscriptionInfo:
+    display_name: str
+    subscription_id: str
+    tenant_id: str
+
+SUBSCRIPTION_CACHE_TTL = 24 * 60 * 60
+
+def cache_directory():
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_root, "azure-devops")
+
+def read_json_cache(file_name, default=None):
+    try:
+        with open(os.path.join(cache_directory(), file_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
 
-    credential = DefaultAzureCredential()
-    subscription_client = SubscriptionClient(credential)
+def write_json_cache(file_name, data):
+    path = os.path.join(cache_directory(), file_name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+            json.dump(data, f, indent=2)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f"--Unable to write cache file {path}: {e}")
+
+def read_subscription_cache():
+    cache = read_json_cache("subscriptions.json", {})
+    now = time.time()
+    return {name: entry for name, entry in cache.items() if entry.get("expires", 0) > now}
+
+def write_subscription_cache(cache):
+    write_json_cache("subscriptions.json", cache)
+
+def cache_subscription(cache, subscription):
+    cache[subscription.display_name] = {
+        "subscription_id": subscription.subscription_id,
+        "tenant_id": subscription.tenant_id,
+        "expires": time.time() + SUBSCRIPTION_CACHE_TTL
+    }
+    write_subscription_cache(cache)
+    return SubscriptionInfo(subscription.display_name, subscription.subscription_id, subscription.tenant_id)
+
+def lookup_subscription(subscription_name, subscription_id=None):
+    cache = read_subscription_cache()
+    entry = cache.get(subscription_name)
+    if entry and (not subscription_id or entry["subscription_id"] == subscription_id):
+        return SubscriptionInfo(subscription_name, entry["subscription_id"], entry["tenant_id"])
+
+    # Cache miss (or stale entry) - drop it and ask ARM
+    cache.pop(subscription_name, None)
+    subscription_client = get_client_pool().subscription_client()
 
     try:
-        # Get subscription details
-        subscription_details = subscription_client.subscriptions.list()
-        known_subscriptions = {}
-        for subscription in subscription_details:
-            name = subscription.display_name
-            tenant_id = subscription.tenant_id
-            known_subscriptions [name] = subscription
+        if subscription_id:
+            # The workbook names the subscription ID, so a single GET is enough
+            subscription = subscription_client.subscriptions.get(subscription_id)
+            if subscription.display_name != subscription_name:
+                raise ValueError(f"Subscription ID {subscription_id} is '{subscription.display_name}', not '{subscription_name}'")
+            return cache_subscription(cache, subscription)
+
+        # Stop enumerating as soon as the subscription is found
+        for subscription in subscription_client.subscriptions.list():
+            if subscription.display_name == subscription_name:
+                return cache_subscription(cache, subscription)
     except ClientAuthenticationError:
         raise ValueError("Authentication failed - ensure you are logged in to Azure CLI")
+    except ResourceNotFoundError:
+        pass
 
-    if subscription_name not in known_subscriptions:
+    write_subscription_cache(cache)
+    return None
+
+@profiled("validate_azure")
+def validate_azure (subscription_name, subscription_id=None):
+    subscription = lookup_subscription(subscription_name, subscription_id)
+    if not subscription:
         raise ValueError(f"Subscription {subscription_name} not found in your credentials")
-    subscription = known_subscriptions [subscription_name]
     print (f"Using Azure subscription '{subscription_name}' ({subscription.subscription_id})")
 
     return subscription
 
-def validate_resources(config_file):
-    # Load the workbook
-    workbook = openpyxl.load_workbook(config_file)
-    # Read Pulumi worksheet
-    pulumi_sheet = workbook['Configuration']
-    config = worksheet_to_dict(pulumi_sheet)
-    templates = {}
-    templates.update(defaultTemplates)
-    if 'Templates' in workbook:
-        templates_sheet = workbook['Templates']
-        templates.update (rows_to_dicts(templates_sheet))
-    workbook.close()
+def validate_configuration(configuration):
+    # Every check that needs only the workbook
+    config = configuration.config
+    templates = configuration.templates
     for name, value in templates.items():
         print (f"{name}: {value}")
     if 'Subscription' not in config:
@@ -109,29 +623,77 @@ def validate_resources(config_file):
     pulumi_storage_account = config.get("Pulumi Storage Account", "pulumi").lower()
     pulumi_container = config.get("Pulumi Container", "pulumi").lower()
     pulumi_location = config.get("Pulumi Location", "uksouth").lower()
-    subscription = validate_azure(subscription_name)
 
-    return templates, subscription, subscription_slug, pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container
+    # Catch names Azure would reject before making any network calls
+    validate_resource_names(configuration, configuration.deployments)
 
-def send_script_to_pulumi(script, initialiser=""):
-    if initialiser: script = initialiser + "\n" + script
-    print ("Sending to Pulumi", script)
-    with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
-        f.write(script)
-        f.flush()
-        subprocess.run(["bash", f.name], check=True)
-        os.remove (f.name)
+    return templates, subscription_name, subscription_slug, pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container
 
-def ensure_pulumi_resources(subscription_id, resource_group_name, storage_account_name, location, container_name, stack_name):
+def validate_resources(configuration):
+    templates, subscription_name, subscription_slug, pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container =\
+        validate_configuration(configuration)
 
-    # Create a credential object using DefaultAzureCredential
-    credential = DefaultAzureCredential()
+    subscription = validate_azure(subscription_name, configuration.config.get('Subscription ID'))
 
-    # Create a client object for Resource Management
-    resource_client = ResourceManagementClient(credential, subscription_id)
+    return templates, subscription, subscription_slug, pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container
 
-    # Create a client object for Storage Management
-    storage_client = StorageManagementClient(credential, subscription_id)
+def validate_resource_groups(resource_client, resource_group_names, subscription_name):
+    # A single list() round-trip covers every distinct group named in the sheet,
+    # however many rows share them. Azure resource group names are case-insensitive.
+    known_groups = {group.name.lower(): group for group in resource_client.resource_groups.list()}
+    missing = sorted(name for name in resource_group_names if name.lower() not in known_groups)
+    if missing:
+        names = ", ".join(f"'{name}'" for name in missing)
+        raise ValueError(f"Resource group(s) {names} do not exist in subscription '{subscription_name}'")
+    return {name: known_groups[name.lower()] for name in resource_group_names}
+
+PULUMI_PROJECT = "devops"
+
+def pulumi_workspace(storage_account_name, storage_key, container_name, program=None):
+    # One LocalWorkspace per run: the backend credentials travel in its
+    # environment and the backend URL in its project settings, so every
+    # Automation API call (and --pulumi passthrough) reuses the same login
+    from pulumi.automation import LocalWorkspace, ProjectSettings
+    project_settings = ProjectSettings(
+        name=PULUMI_PROJECT,
+        runtime="python",
+        backend={"url": f"azblob://{container_name}"}
+    )
+    return LocalWorkspace(
+        program=program,
+        project_settings=project_settings,
+        env_vars={
+            "AZURE_STORAGE_ACCOUNT": storage_account_name,
+            "AZURE_STORAGE_KEY": storage_key,
+            "PULUMI_CONFIG_PASSPHRASE": "No secrets here"
+        }
+    )
+
+def run_pulumi_command(stack_run, command):
+    # Pass an arbitrary pulumi command through to the CLI, run inside the
+    # workspace so it picks up the same project, backend and credentials
+    workspace = select_stack(stack_run).workspace
+    subprocess.run(["pulumi", *shlex.split(command)], cwd=workspace.work_dir,
+        env={**os.environ, **workspace.env_vars}, check=True)
+
+# Pulumi backends already bootstrapped by this process, so workbooks sharing a
+# backend in a batch run only pay for it once
+_pulumi_backends = {}
+_pulumi_backends_lock = threading.Lock()
+
+def ensure_pulumi_backend(subscription_id, resource_group_name, storage_account_name, location):
+    key = (subscription_id, resource_group_name, storage_account_name)
+    with _pulumi_backends_lock:
+        if key not in _pulumi_backends:
+            _pulumi_backends[key] = create_pulumi_backend(subscription_id, resource_group_name, storage_account_name, location)
+        return _pulumi_backends[key]
+
+def create_pulumi_backend(subscription_id, resource_group_name, storage_account_name, location):
+
+    # Management clients share the run's credential and connection pool
+    client_pool = get_client_pool()
+    resource_client = client_pool.resource_client(subscription_id)
+    storage_client = client_pool.storage_client(subscription_id)
 
     # Check if the resource group exists, and create if not
     resource_group = resource_client.resource_groups.check_existence(resource_group_name)
@@ -158,141 +720,525 @@ def ensure_pulumi_resources(subscription_id, resource_group_name, storage_accoun
     storage_keys = storage_client.storage_accounts.list_keys(resource_group_name, storage_account_name)
     storage_key = storage_keys.keys[0].value
     storage_url = f"https://{storage_account_name}.blob.core.windows.net"
+    return storage_url, storage_key
+
+def stack_manifest_name(storage_account_name, container_name):
+    return f"stacks-{storage_account_name}-{container_name}.json"
+
+def ensure_pulumi_stack(blob_service_client, workspace, storage_account_name, container_name, stack_name, recheck=False):
+    # Stacks already seen in this backend are remembered locally, so the usual
+    # case costs no backend round-trips however many blobs the container holds.
+    # recheck ignores the manifest for this stack, for when it has turned out
+    # to be wrong (the stack or its container was deleted).
+    manifest_name = stack_manifest_name(storage_account_name, container_name)
+    manifest = read_json_cache(manifest_name)
+    known_stacks = set(manifest or [])
+    if recheck:
+        known_stacks.discard(stack_name)
+
+    if stack_name not in known_stacks:
+        # Check if the container exists, and create if not
+        container_client = blob_service_client.get_container_client(container_name)
+        if not container_client.exists():
+            print(f"Creating Pulumi container '{container_name}'...")
+            blob_service_client.create_container(container_name)
+
+        # Check if Pulumi stack for this spreadsheet has been set up. The project
+        # itself needs no separate creation: the workspace's settings define it.
+        stack_prefix = f".pulumi/stacks/{PULUMI_PROJECT}/"
+        if manifest is None:
+            # No manifest yet - seed it with one listing scoped to this project's stacks
+            known_stacks = {
+                blob.name[len(stack_prefix):-len(".json")]
+                    for blob in container_client.list_blobs(name_starts_with=stack_prefix)
+                    if blob.name.endswith(".json")
+            }
+        elif container_client.get_blob_client(f"{stack_prefix}{stack_name}.json").exists():
+            known_stacks.add(stack_name)
+
+        if stack_name not in known_stacks:
+            # Create a new stack
+            print(f"Creating Pulumi stack {stack_name}")
+            workspace.create_stack(stack_name)
+            known_stacks.add(stack_name)
+        write_json_cache(manifest_name, sorted(known_stacks))
+
+@profiled("ensure_pulumi_resources")
+def ensure_pulumi_resources(subscription_id, resource_group_name, storage_account_name, location, container_name, stack_name):
+    storage_url, storage_key = ensure_pulumi_backend(subscription_id, resource_group_name, storage_account_name, location)
 
     # Create a BlobServiceClient to manage containers
-    blob_service_client = BlobServiceClient(account_url=storage_url, credential=storage_key)
-
-    # Check if the container exists, and create if not
-    container_client = blob_service_client.get_container_client(container_name)
-    if not container_client.exists():
-        print(f"Creating Pulumi container '{container_name}'...")
-        blob_service_client.create_container(container_name)
-
-    # Pulumi stack file name
-    stack_file_name = f".pulumi/stacks/devops/{stack_name}.json"
-
-    PULUMI_INITIALISATION_SCRIPT = f"""
-        #!/bin/bash
-        set -e
-        export AZURE_STORAGE_ACCOUNT={storage_account_name}
-        export AZURE_STORAGE_KEY={storage_key}
-        export CONFIG_FILE=f"{stack_name}.xlsx"
-        export PULUMI_CONFIG_PASSPHRASE="No secrets here"
-        pulumi login --cloud-url azblob://{container_name}
-        pulumi stack ls
-    """
-
-    # Check if Pulumi project has been set up
-    blob_list = list(container_client.list_blobs())
-    project_exists = any(blob.name.startswith('.pulumi') for blob in blob_list)
-    if not project_exists:
-        print(f"Creating Pulumi project 'devops'")
-        send_script_to_pulumi(
-            "pulumi new azure-python --name devops --yes",
-            PULUMI_INITIALISATION_SCRIPT
-        )
-
-    # Check if Pulumi stack for this spreadsheet has been set up
-    stack_exists = any(blob.name == stack_file_name for blob in blob_list)
-    if not stack_exists:       
-        # Create a new stack
-        print(f"Creating Pulumi stack {stack_name}")
-        send_script_to_pulumi(f"pulumi stack init {stack_name}", PULUMI_INITIALISATION_SCRIPT)
-    print(f"All Azure resources for Pulumi stack '{stack_name}' are set up in storage account '{storage_account_name}'")
-    return storage_url, storage_key, PULUMI_INITIALISATION_SCRIPT
+    blob_service_client = get_client_pool().blob_service_client(storage_url, storage_key)
 
-def upload_file_to_blob(account_url, account_key, container_name, file_path):
-    try:
-        # Create a BlobServiceClient using the storage account name and account key
-        blob_service_client = BlobServiceClient(account_url, credential=account_key)
-        
-        # Get a reference to the container
-        container_client = blob_service_client.get_container_client(container_name)
+    workspace = pulumi_workspace(storage_account_name, storage_key, container_name)
 
-        # Get the file name from the file path
-        local_file_name = os.path.basename(file_path)
+    ensure_pulumi_stack(blob_service_client, workspace, storage_account_name, container_name, stack_name)
 
-        # Create a blob client using the local file name as the name for the blob
-        blob_client = container_client.get_blob_client(blob=local_file_name)
+    print(f"All Azure resources for Pulumi stack '{stack_name}' are set up in storage account '{storage_account_name}'")
+    return storage_url, storage_key, workspace
+
+# Workbook snapshots are uploaded in blocks of this size, this many at a time
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 4
+
+# Outcome of uploading a file to blob storage
+@dataclasses.dataclass
+class BlobUploadResult:
+    blob_name: str
+    url: str = None
+    size: int = 0
+    content_md5: str = None
+    etag: str = None
+    seconds: float = 0.0
+    error: Exception = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def file_md5(file_path, chunk_size=UPLOAD_BLOCK_SIZE):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+def snapshot_blob_name(stack_name, file_path, digest, timestamp=None):
+    # snapshots/<stack>/<UTC time>-<hash><extension>: every upload is kept, and
+    # names sort in the order they were taken
+    timestamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(timestamp))
+    extension = os.path.splitext(file_path)[1]
+    return f"snapshots/{stack_name}/{timestamp}-{digest[:12]}{extension}"
+
+def upload_file_to_blob(account_url, account_key, container_name, file_path, blob_name=None,
+                        max_concurrency=UPLOAD_MAX_CONCURRENCY, block_size=UPLOAD_BLOCK_SIZE):
+    # Stream a file to a block blob in parallel blocks, each checked with an MD5
+    # by the service, then read it back to check the whole file's MD5. The
+    # account URL can point at a local emulator such as Azurite
+    # (http://127.0.0.1:10000/devstoreaccount1).
+    from azure.storage.blob import ContentSettings
+
+    result = BlobUploadResult(blob_name or os.path.basename(file_path))
+    started = time.perf_counter()
+    try:
+        md5 = file_md5(file_path)
+        result.size = os.path.getsize(file_path)
+        result.content_md5 = md5.hex()
 
-        # Upload the local file to the blob
+        blob_service_client = get_client_pool().blob_service_client(account_url, account_key,
+            max_block_size=block_size, max_single_put_size=block_size)
+        blob_client = blob_service_client.get_blob_client(container_name, result.blob_name)
         with open(file_path, "rb") as data:
-            blob_client.upload_blob(data, overwrite=True)
-
-        print(f"..File {local_file_name} uploaded to blob container {container_name}")
+            blob_client.upload_blob(data, length=result.size, overwrite=True, validate_content=True,
+                max_concurrency=max_concurrency, content_settings=ContentSettings(content_md5=bytearray(md5)))
+
+        # Check what the service now holds. The MD5 set above is only recorded,
+        # not checked, for a blob uploaded in blocks, so hash the content itself
+        downloader = blob_client.download_blob(max_concurrency=max_concurrency)
+        stored_md5 = hashlib.md5()
+        for chunk in downloader.chunks():
+            stored_md5.update(chunk)
+        if downloader.size != result.size or stored_md5.digest() != md5:
+            raise ValueError(f"{result.blob_name} does not match {file_path} after upload")
+        result.url = blob_client.url
+        result.etag = downloader.properties.etag
+        print(f"..File {os.path.basename(file_path)} uploaded to {container_name}/{result.blob_name}")
+    except (AzureError, OSError, ValueError) as e:
+        result.error = e
+        print(f'--Failed to upload {file_path} to {container_name}: {e}')
+    finally:
+        result.seconds = time.perf_counter() - started
+    return result
+
+def configuration_model(configuration):
+    # Normalised, JSON-friendly form of the workbook: the same content always
+    # gives the same fingerprint, whatever the .xlsx bytes look like. The
+    # program version is part of it, so a stack whose workbook is unchanged is
+    # still updated when deploy_resources changes what it declares.
+    model = {
+        "program_version": PLAN_VERSION,
+        "config": dict(sorted(configuration.config.items())),
+        "templates": {resource_type.value: template for resource_type, template in configuration.templates.items()},
+        "deployments": [dict(row) for row in configuration.deployments]
+    }
+    canonical = json.dumps(model, sort_keys=True, default=str)
+    model["fingerprint"] = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    return json.loads(json.dumps(model, default=str))
+
+def deployed_model_blob_name(stack_name):
+    return f"{stack_name}.model.json"
+
+def download_deployed_model(account_url, account_key, container_name, stack_name):
+    blob_service_client = get_client_pool().blob_service_client(account_url, account_key)
+    blob_client = blob_service_client.get_blob_client(container_name, deployed_model_blob_name(stack_name))
+    try:
+        return json.loads(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        return None
 
+def upload_deployed_model(account_url, account_key, container_name, stack_name, model):
+    try:
+        blob_service_client = get_client_pool().blob_service_client(account_url, account_key)
+        blob_client = blob_service_client.get_blob_client(container_name, deployed_model_blob_name(stack_name))
+        blob_client.upload_blob(json.dumps(model, indent=2), overwrite=True)
     except Exception as e:
-        print(f'--Failed to upload {file_path} to Pulumi container: {e}')
+        print(f'--Failed to record the deployed configuration of {stack_name}: {e}')
+
+def deployment_row_key(row):
+    return (str(row.get("Defines") or "").lower(), str(row.get("Service") or "").lower(), str(row.get("App") or "").lower())
+
+def diff_deployments(previous_rows, current_rows):
+    # Match rows on what they define rather than their position in the sheet
+    previous = {deployment_row_key(row): row for row in previous_rows}
+    current = {deployment_row_key(row): row for row in current_rows}
+    added = [current[key] for key in current if key not in previous]
+    removed = [previous[key] for key in previous if key not in current]
+    changed = [(previous[key], current[key]) for key in current if key in previous and previous[key] != current[key]]
+    return added, removed, changed
+
+def print_deployment_diff(stack_name, previous_rows, current_rows):
+    added, removed, changed = diff_deployments(previous_rows, current_rows)
+    print(f"Deployments changed in stack '{stack_name}' since the last update:")
+    for row in added:
+        print(f"  + {row}")
+    for row in removed:
+        print(f"  - {row}")
+    for before, after in changed:
+        columns = sorted(set(before) | set(after))
+        print(f"  ~ {', '.join(f'{c}: {before.get(c)!r} -> {after.get(c)!r}' for c in columns if before.get(c) != after.get(c))} in {after}")
+    if not (added or removed or changed):
+        print("  (only the Configuration or Templates worksheets changed)")
+
+# Pulumi type tokens of the resources deploy_resources declares, used to build
+# the URNs passed to --target
+PULUMI_RESOURCE_TYPES = {
+    ResourceTypes.APP_SERVICE_PLAN: "azure:appservice/servicePlan:ServicePlan",
+    ResourceTypes.STORAGE_ACCOUNT: "azure:storage/account:Account",
+    ResourceTypes.FILE_SHARE: "azure:storage/share:Share",
+    ResourceTypes.APP_INSIGHTS: "azure:appinsights/insights:Insights",
+    ResourceTypes.KEY_VAULT: "azure:keyvault/keyVault:KeyVault",
+    ResourceTypes.APP_SERVICE: "azure:appservice/appService:AppService",
+    ResourceTypes.KEY_VAULT_ACCESS_POLICY: "azure:keyvault/accessPolicy:AccessPolicy"
+}
 
-def deploy_resources(config_file):
+SECRET_RESOURCE_TYPE = "azure:keyvault/secret:Secret"
 
-    stack_name = os.path.splitext(os.path.basename(config_file))[0]
+# Secrets each service keeps in its Key Vault
+STORAGE_SECRET_NAMES = ("azureStorageAccountKey", "azureStorageAccountName")
 
-    templates, subscription, subscription_slug, pulumi_resource_group, \
-            pulumi_storage_account, pulumi_location, pulumi_container =\
-            validate_resources(config_file)
-    ensure_pulumi_resources(subscription.subscription_id,
-        pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container, stack_name)
+def secret_resource_names(names):
+    # Secret name -> Pulumi name for a service row. Prefixed with the vault's
+    # name so each service's secrets are separate resources in the stack.
+    return {secret: f"{names[ResourceTypes.KEY_VAULT]}-{secret}" for secret in STORAGE_SECRET_NAMES}
 
-    # Read deployments worksheet
-    workbook = openpyxl.load_workbook(config_file)
+_template_formatter = string.Formatter()
 
-    deployments_sheet = workbook['Deployments']
-    deployments = rows_to_dicts(deployments_sheet)
-    workbook.close()
+@functools.lru_cache(maxsize=None)
+def compile_template(template):
+    # Parse a resource name template once; the returned function renders it
+    # for a row without re-parsing the format string
+    try:
+        parsed = tuple(_template_formatter.parse(template))
+    except ValueError as e:
+        raise ValueError(f"Invalid name template '{template}': {e}")
+
+    def render(row):
+        name = []
+        for literal, field, format_spec, conversion in parsed:
+            name.append(literal)
+            if field is not None:
+                value = row[field]
+                if conversion:
+                    value = _template_formatter.convert_field(value, conversion)
+                name.append(format(value, format_spec or ""))
+        return "".join(name)
+
+    return render
+
+def row_resource_names(templates, deployment):
+    # Pulumi resource names declared for one Deployments row
+    defines = deployment.defines
+    if defines == "service":
+        resource_types = [ResourceTypes.APP_SERVICE_PLAN, ResourceTypes.STORAGE_ACCOUNT]
+        if deployment.files_quota:
+            resource_types.append(ResourceTypes.FILE_SHARE)
+        resource_types += [ResourceTypes.APP_INSIGHTS, ResourceTypes.KEY_VAULT]
+    elif defines == "app":
+        resource_types = [ResourceTypes.KEY_VAULT_ACCESS_POLICY]
+    else:
+        return {}
 
-    # Advise Pulumi of the current configuration
+    names = {}
+    for resource_type in resource_types:
+        try:
+            names[resource_type] = compile_template(templates[resource_type])(deployment)
+        except KeyError as e:
+            raise ValueError(f"The {resource_type.value} template '{templates[resource_type]}' uses {e}, which is not a deployments worksheet column")
+    if defines == "app":
+        names = {ResourceTypes.APP_SERVICE: deployment.get("App"), **names}
+    return names
+
+def render_resource_names(templates, deployments):
+    # Names for every row in one pass, each template compiled only once
+    return [row_resource_names(templates, deployment) for deployment in deployments]
+
+# Azure naming rules for the resources given explicit names: (min length, max
+# length, pattern, description). See "Naming rules and restrictions for Azure
+# resources" in the Azure documentation.
+AZURE_NAMING_RULES = {
+    ResourceTypes.APP_SERVICE_PLAN: (1, 60, r"[a-zA-Z0-9-]+", "letters, numbers and hyphens"),
+    ResourceTypes.STORAGE_ACCOUNT: (3, 24, r"[a-z0-9]+", "lowercase letters and numbers"),
+    ResourceTypes.FILE_SHARE: (3, 63, r"[a-z0-9](?!.*--)[a-z0-9-]*[a-z0-9]",
+        "lowercase letters, numbers and single hyphens, starting and ending with a letter or number"),
+    ResourceTypes.APP_INSIGHTS: (1, 255, r"[^%&\\?/]+", "any characters except %&\\?/"),
+    ResourceTypes.KEY_VAULT: (3, 24, r"[a-zA-Z](?!.*--)[a-zA-Z0-9-]*[a-zA-Z0-9]",
+        "letters, numbers and single hyphens, starting with a letter and ending with a letter or number"),
+    # App Services are auto-named by Pulumi, which appends an 8 character suffix
+    ResourceTypes.APP_SERVICE: (2, 52, r"[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?",
+        "letters, numbers and hyphens, starting and ending with a letter or number"),
+}
 
-    def validate_deployments_column(name, index, default=None):
-        if not name in deployments [index] or\
-            not deployments [index][name] or\
-            not deployments [index][name].strip():
-            if default:
-                deployments [index][name] = default
+# Storage account and Key Vault names must be unique across all of Azure; the
+# rest must still be unique within the stack, as Pulumi resource names
+GLOBALLY_UNIQUE_TYPES = (ResourceTypes.STORAGE_ACCOUNT, ResourceTypes.KEY_VAULT)
+
+def validate_resource_names(configuration, deployments):
+    # Check every rendered name before anything is sent to Azure, reporting all
+    # the problems at once
+    errors = []
+    seen = {}
+    for i, names in enumerate(render_resource_names(configuration.templates, deployments)):
+        for resource_type, name in names.items():
+            rule = AZURE_NAMING_RULES.get(resource_type)
+            if rule:
+                min_length, max_length, pattern, description = rule
+                if not min_length <= len(name) <= max_length:
+                    errors.append(f"Row {i+1}: {resource_type.value} name '{name}' must be {min_length}-{max_length} characters long (it is {len(name)})")
+                elif not re.fullmatch(pattern, name):
+                    errors.append(f"Row {i+1}: {resource_type.value} name '{name}' may only contain {description}")
+            key = (resource_type, name.lower())
+            if key in seen:
+                scope = "all of Azure" if resource_type in GLOBALLY_UNIQUE_TYPES else "the stack"
+                errors.append(f"Row {i+1}: {resource_type.value} name '{name}' is already used by row {seen[key]+1} and must be unique across {scope}")
             else:
-                raise ValueError(f"'{name}' is missing from row {index+1} of the deployments worksheet")
-
-    # Create a credential object using DefaultAzureCredential
-    credential = DefaultAzureCredential()
-
-    # Create a client object for Resource Management
-    resource_client = ResourceManagementClient(credential, subscription.subscription_id)
-
-    resource_groups = {}
-
-    for i, deployment in enumerate (deployments):
-        validate_deployments_column('Defines', i)
-        validate_deployments_column('Resource Group', i)
-        validate_deployments_column('Service', i)
-        validate_deployments_column('sku', i, "B1")
-        validate_deployments_column('Region', i, "uksouth")
-        validate_deployments_column('Files quota', i, "50")
-        validate_deployments_column('Stopped', i, "1")
-        deployment['Subscription'] = subscription_slug.lower ()
-
-        # Check if the resource group exists
-        resource_group_name = deployment['Resource Group']
-        resource_group_exists = resource_client.resource_groups.check_existence(resource_group_name)
-        if resource_group_exists:
-            resource_group = resource_client.resource_groups.get(resource_group_name)
+                seen[key] = i
+        if ResourceTypes.KEY_VAULT in names:
+            for name in secret_resource_names(names).values():
+                key = (SECRET_RESOURCE_TYPE, name)
+                if key in seen:
+                    errors.append(f"Row {i+1}: Key Vault secret '{name}' is already declared by row {seen[key]+1} and must be unique across the stack")
+                else:
+                    seen[key] = i
+    if errors:
+        raise ValueError("Invalid resource names in the deployments worksheet:\n  " + "\n  ".join(errors))
+
+# Service resources an app depends on (the file share only if the service has
+# one), so must be part of any targeted run for it
+APP_DEPENDENCIES = (ResourceTypes.APP_SERVICE_PLAN, ResourceTypes.APP_INSIGHTS, ResourceTypes.KEY_VAULT,
+    ResourceTypes.STORAGE_ACCOUNT, ResourceTypes.FILE_SHARE)
+
+# Where a service's file share is mounted in each of its apps
+FILES_MOUNT_PATH = "/mounts/files"
+
+def resource_urn(configuration, resource_type, name):
+    return f"urn:pulumi:{configuration.stack_name}::{PULUMI_PROJECT}::{resource_type}::{name}"
+
+def stack_targets(configuration, services=(), apps=()):
+    # URNs of the resources declared for the selected services and apps. A
+    # service brings its apps with it; an app brings only the service resources
+    # it depends on, so sibling apps are left alone.
+    services = {service.lower() for service in services}
+    apps = set(apps)
+    deployments = configuration.deployments
+    dependencies = {
+        deployment['Service'] for deployment in deployments
+            if deployment.defines == "app" and deployment.get("App") in apps
+    }
+
+    found = set()
+    urns = []
+    for deployment in deployments:
+        defines = deployment.defines
+        names = row_resource_names(configuration.templates, deployment)
+        if defines == "service" and deployment['Service'] in services:
+            found.add(deployment['Service'])
+            urns.extend(resource_urn(configuration, SECRET_RESOURCE_TYPE, name) for name in secret_resource_names(names).values())
+        elif defines == "service" and deployment['Service'] in dependencies:
+            names = {resource_type: names[resource_type] for resource_type in APP_DEPENDENCIES if resource_type in names}
+        elif defines == "app" and (deployment['Service'] in services or deployment.get("App") in apps):
+            found.add(deployment.get("App"))
         else:
-            raise ValueError(f"Resource group '{resource_group_name}' does not exist in subscription '{subscription.name}'")
-        resource_groups [resource_group_name] = resource_group
+            continue
+        urns.extend(resource_urn(configuration, PULUMI_RESOURCE_TYPES[resource_type], name)
+            for resource_type, name in names.items())
+
+    missing = sorted((services | apps) - found)
+    if missing:
+        raise ValueError(f"{', '.join(missing)} not found in the deployments worksheet of {configuration.stack_name}")
+    return urns
+
+# Bump whenever deploy_resources changes what it declares or how: plans rendered
+# by older code are not compared with new ones, and every stack counts as
+# changed (see configuration_model), so the next run applies the change
+PLAN_VERSION = 2
+
+def plan_resource(resource_type, name, inputs, depends_on=()):
+    return {"type": resource_type, "name": name, "inputs": inputs, "depends_on": list(depends_on)}
+
+def render_plan(configuration):
+    # The resources deploy_resources declares, as plain data: Pulumi type,
+    # name, the inputs known before deployment and the names of the resources
+    # each one depends on. Built from the workbook alone - no Pulumi engine and
+    # no calls to Azure.
+    deployments = configuration.deployments
+    resources = []
+    services = {}
+    for i, (deployment, names) in enumerate(zip(deployments, render_resource_names(configuration.templates, deployments))):
+        defines = deployment.defines
+        resource_group_name = deployment['Resource Group']
 
+        if defines == "service":
+            if deployment['Service'] in services:
+                raise ValueError(f"Row {i+1}: Service '{deployment['Service']}' has already been created by a previous row of the deployments worksheet")
+            services[deployment['Service']] = names
+            plan_name = names[ResourceTypes.APP_SERVICE_PLAN]
+            storage_name = names[ResourceTypes.STORAGE_ACCOUNT]
+            key_vault_name = names[ResourceTypes.KEY_VAULT]
+            resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.APP_SERVICE_PLAN], plan_name, {
+                "resource_group_name": resource_group_name, "location": deployment['Region'], "os_type": "Linux", "sku_name": deployment['sku']}))
+            resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.STORAGE_ACCOUNT], storage_name, {
+                "resource_group_name": resource_group_name, "account_replication_type": "LRS", "account_tier": "Standard"}))
+            if ResourceTypes.FILE_SHARE in names:
+                resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.FILE_SHARE], names[ResourceTypes.FILE_SHARE], {
+                    "quota": deployment.files_quota}, [storage_name]))
+            resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.APP_INSIGHTS], names[ResourceTypes.APP_INSIGHTS], {
+                "resource_group_name": resource_group_name, "application_type": "web"}))
+            resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.KEY_VAULT], key_vault_name, {
+                "resource_group_name": resource_group_name, "sku_name": "standard"}))
+            secret_names = secret_resource_names(names)
+            resources.append(plan_resource(SECRET_RESOURCE_TYPE, secret_names["azureStorageAccountKey"], {}, [key_vault_name, storage_name]))
+            resources.append(plan_resource(SECRET_RESOURCE_TYPE, secret_names["azureStorageAccountName"], {"value": storage_name}, [key_vault_name]))
+
+        elif defines == "app":
+            service = services.get(deployment['Service'])
+            if service is None:
+                raise ValueError(f"Row {i+1}: Service '{deployment['Service']}' has not been created by a previous row of the deployments worksheet")
+            app_name = names[ResourceTypes.APP_SERVICE]
+            depends_on = [service[resource_type] for resource_type in APP_DEPENDENCIES if resource_type in service]
+            inputs = {
+                "resource_group_name": resource_group_name,
+                "app_settings": {"WEBSITE_STOPPED": "1" if deployment.status is DeploymentStatus.STOPPED else "0"}
+            }
+            if ResourceTypes.FILE_SHARE in service:
+                inputs["app_settings"]["FILES_ROOT"] = FILES_MOUNT_PATH
+            resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.APP_SERVICE], app_name, inputs, depends_on))
+            resources.append(plan_resource(PULUMI_RESOURCE_TYPES[ResourceTypes.KEY_VAULT_ACCESS_POLICY],
+                names[ResourceTypes.KEY_VAULT_ACCESS_POLICY], {}, [service[ResourceTypes.KEY_VAULT], app_name]))
+    return resources
+
+def plan_cache_name(configuration):
+    # Next to the stack: one plan per backend storage account, container and stack
+    account = configuration.config.get("Pulumi Storage Account", "pulumi").lower()
+    container = configuration.config.get("Pulumi Container", "pulumi").lower()
+    return f"plan-{account}-{container}-{configuration.stack_name}.json"
+
+def read_plan(configuration):
+    # The plan recorded by the last full update, if it was rendered by this
+    # version of the code
+    cached = read_json_cache(plan_cache_name(configuration))
+    if not cached or cached.get("version") != PLAN_VERSION:
+        return None
+    return cached
+
+def write_plan(configuration, resources):
+    write_json_cache(plan_cache_name(configuration), {
+        "version": PLAN_VERSION,
+        "workbook": configuration.digest,
+        "resources": resources
+    })
+
+def stack_plan(configuration):
+    # The cached plan when the workbook is the one it was rendered from
+    cached = read_plan(configuration)
+    if cached and cached["workbook"] == configuration.digest:
+        return cached["resources"]
+    return render_plan(configuration)
+
+def diff_plans(previous_resources, current_resources):
+    # Expected creates, deletes and updates (with the inputs that changed),
+    # matching resources on their type and name
+    previous = {(r["type"], r["name"]): r for r in previous_resources}
+    current = {(r["type"], r["name"]): r for r in current_resources}
+    creates = [current[key] for key in current if key not in previous]
+    deletes = [previous[key] for key in previous if key not in current]
+    updates = []
+    for key in current:
+        if key in previous and previous[key] != current[key]:
+            before, after = previous[key], current[key]
+            changed = {name: (before["inputs"].get(name), after["inputs"].get(name))
+                for name in sorted(set(before["inputs"]) | set(after["inputs"]))
+                    if before["inputs"].get(name) != after["inputs"].get(name)}
+            if before["depends_on"] != after["depends_on"]:
+                changed["depends_on"] = (before["depends_on"], after["depends_on"])
+            updates.append((after, changed))
+    return creates, deletes, updates
+
+def print_plan_diff(stack_name, previous_resources, current_resources):
+    creates, deletes, updates = diff_plans(previous_resources, current_resources)
+    print(f"Expected changes to stack '{stack_name}' (from the workbook alone):")
+    for resource in creates:
+        print(f"  + {resource['type']} {resource['name']}")
+    for resource in deletes:
+        print(f"  - {resource['type']} {resource['name']}")
+    for resource, changed in updates:
+        print(f"  ~ {resource['type']} {resource['name']}: {', '.join(f'{name}: {before!r} -> {after!r}' for name, (before, after) in changed.items())}")
+    if not (creates or deletes or updates):
+        print("  (none)")
+    return creates, deletes, updates
+
+def print_expected_changes(configuration):
+    # Offline: compare the workbook's plan with the one recorded by the last
+    # full update of the stack
+    resources = stack_plan(configuration)
+    previous = read_plan(configuration)
+    if previous is None:
+        print(f"No plan recorded for stack '{configuration.stack_name}' - all {len(resources)} resources are new to this machine")
+        previous = {"resources": []}
+    print_plan_diff(configuration.stack_name, previous["resources"], resources)
+    return resources
+
+@profiled("deploy_resources")
+def deploy_resources(configuration, subscription):
+
+    import pulumi
+    import pulumi_azure
+
+    # The Pulumi program runs after validate_resources and ensure_pulumi_resources
+    # so it works from the already-parsed workbook rather than reloading it
+    deployments = configuration.deployments
+    templates = configuration.templates
+
+    # Check that every resource group referenced by the sheet exists
+    resource_client = get_client_pool().resource_client(subscription.subscription_id)
+    with profiler.phase("validate_resource_groups"):
+        resource_groups = validate_resource_groups(resource_client,
+            {deployment['Resource Group'] for deployment in deployments}, subscription.display_name)
+
+    resource_names = render_resource_names(templates, deployments)
     service_configurations = {}
 
     for i, deployment in enumerate (deployments):
 
-        resource_group_name = deployment['Resource Group']
+        resource_group_name = deployment.resource_group
         resource_group = resource_groups [resource_group_name]
-        service_name = deployment['Service'] = deployment['Service'].lower()        
-        location = deployment['Region'] = deployment['Region'].lower()
-        app_name = deployment.get ("App")
-        quota_str = deployment.get ("Files quota")
-        quota = int(quota_str) if quota_str else 0
-        sku = deployment['sku']
-
-        defines = deployment['Defines'].lower()
+        service_name = deployment.service
+        location = deployment.region
+        app_name = deployment.app
+        quota = deployment.files_quota
+        sku = deployment.sku
+
+        defines = deployment.defines
+        names = resource_names[i]
         print (deployment)
 
         # Create an App Service Plan
@@ -301,7 +1247,7 @@ def deploy_resources(config_file):
             if service_name in service_configurations:
                 raise ValueError(f"Row {i+1}: Service '{service_name}' has already been created by row {service_configurations [service_name]['index']+1} of the deployments worksheet")
 
-            app_service_plan_name = templates [ResourceTypes.APP_SERVICE_PLAN].format (**deployment)
+            app_service_plan_name = names [ResourceTypes.APP_SERVICE_PLAN]
             app_service_plan = pulumi_azure.appservice.ServicePlan(
                 app_service_plan_name, name=app_service_plan_name,
                 resource_group_name=resource_group_name,
@@ -311,7 +1257,7 @@ def deploy_resources(config_file):
             )
 
             # Create a Storage Account
-            storage_account_name = templates [ResourceTypes.STORAGE_ACCOUNT].format (**deployment)
+            storage_account_name = names [ResourceTypes.STORAGE_ACCOUNT]
             storage_account = pulumi_azure.storage.Account(
                 storage_account_name, name=storage_account_name,
                 resource_group_name=resource_group_name,
@@ -319,17 +1265,18 @@ def deploy_resources(config_file):
                 account_tier="Standard"
             )
 
+            file_share = None
             if quota:
                 # Create an Azure File Share
-                file_share_name = templates [ResourceTypes.FILE_SHARE].format (**deployment)
+                file_share_name = names [ResourceTypes.FILE_SHARE]
                 file_share = pulumi_azure.storage.Share(
                     file_share_name, name=file_share_name,
                     storage_account_name=storage_account.name,
-                    quota=int(quota)
+                    quota=quota
                 )
 
             # Create an Application Insights instance
-            app_insights_name = templates [ResourceTypes.APP_INSIGHTS].format (**deployment)
+            app_insights_name = names [ResourceTypes.APP_INSIGHTS]
             app_insights = pulumi_azure.appinsights.Insights(
                 app_insights_name, name=app_insights_name,
                 resource_group_name=resource_group_name,
@@ -337,7 +1284,7 @@ def deploy_resources(config_file):
             )
 
             # Create a Key Vault
-            key_vault_name = templates [ResourceTypes.KEY_VAULT].format (**deployment)
+            key_vault_name = names [ResourceTypes.KEY_VAULT]
             key_vault = pulumi_azure.keyvault.KeyVault(
                 key_vault_name, name=key_vault_name,
                 resource_group_name=resource_group_name,
@@ -345,16 +1292,26 @@ def deploy_resources(config_file):
                 tenant_id=subscription.tenant_id,
             )
 
-            # Store the storage account key in the Key Vault
-            _ = pulumi_azure.keyvault.Secret("azureStorageAccountKey",
+            # Store the storage account key in the Key Vault. The secrets' Pulumi
+            # names used to be just the secret name, which allowed only one
+            # service per stack; the first service keeps those through an alias
+            # so existing stacks aren't replaced.
+            secret_names = secret_resource_names(names)
+            def secret_options(secret):
+                if service_configurations:
+                    return None
+                return pulumi.ResourceOptions(aliases=[pulumi.Alias(name=secret)])
+            _ = pulumi_azure.keyvault.Secret(secret_names["azureStorageAccountKey"],
                          key_vault_id=key_vault.id,
                          value=storage_account.primary_access_key,
-                         name="azureStorageAccountKey"
+                         name="azureStorageAccountKey",
+                         opts=secret_options("azureStorageAccountKey")
             )
-            _ = pulumi_azure.keyvault.Secret("azureStorageAccountName",
+            _ = pulumi_azure.keyvault.Secret(secret_names["azureStorageAccountName"],
                          key_vault_id=key_vault.id,
                          value=storage_account_name,
-                         name="azureStorageAccountName"
+                         name="azureStorageAccountName",
+                         opts=secret_options("azureStorageAccountName")
             )
 
             service_configurations [service_name] = {
@@ -380,21 +1337,42 @@ def deploy_resources(config_file):
             app_service_plan = service ["app_service_plan"]
             resource_group = service ["resource_group"]
             app_insights = service ["app_insights"]
+            key_vault = service ["key_vault"]
+            storage_account = service ["storage_account"]
+            file_share = service ["file_share"]
+
+            app_settings = {
+                "WEBSITE_STOPPED": "1" if deployment.status is DeploymentStatus.STOPPED else "0",
+                "APPINSIGHTS_INSTRUMENTATIONKEY": app_insights.instrumentation_key,
+                "KEY_VAULT_URL": key_vault.vault_uri
+            }
+
+            # Mount the service's file share into the app; the app serves it
+            # through a local cache (app/storage.py)
+            storage_accounts = None
+            if file_share is not None:
+                storage_accounts = [pulumi_azure.appservice.AppServiceStorageAccountArgs(
+                    name="files",
+                    type="AzureFiles",
+                    account_name=storage_account.name,
+                    share_name=file_share.name,
+                    access_key=storage_account.primary_access_key,
+                    mount_path=FILES_MOUNT_PATH
+                )]
+                app_settings ["FILES_ROOT"] = FILES_MOUNT_PATH
 
             # Create an App Service with a system-assigned managed identity
             app_service = pulumi_azure.appservice.AppService(
-                app_name,
+                names [ResourceTypes.APP_SERVICE],
                 resource_group_name=resource_group.name,
                 app_service_plan_id=app_service_plan.id,
-                app_settings={
-                    "WEBSITE_STOPPED": "1" if deployment['Status'] == 'stopped' else "0",
-                    "APPINSIGHTS_INSTRUMENTATIONKEY": app_insights.instrumentation_key
-                },
-                identity=azure.appservice.AppServiceIdentityArgs(type='SystemAssigned') 
+                app_settings=app_settings,
+                storage_accounts=storage_accounts,
+                identity=pulumi_azure.appservice.AppServiceIdentityArgs(type='SystemAssigned')
             )
 
             # Assign access policy to the Key Vault for the managed identity
-            access_policy_name = templates [ResourceTypes.KEY_VAULT_ACCESS_POLICY].format (**deployment)
+            access_policy_name = names [ResourceTypes.KEY_VAULT_ACCESS_POLICY]
             access_policy = pulumi_azure.keyvault.AccessPolicy(access_policy_name,
                 key_vault_id=key_vault.id,
                 tenant_id=subscription.tenant_id,
@@ -402,56 +1380,328 @@ def deploy_resources(config_file):
                 key_permissions=[
                     "Get",
                     "List"
+                ],
+                secret_permissions=[
+                    "Get",
+                    "List"
                 ])
 
+# Everything needed to run Pulumi against one workbook's stack
+@dataclasses.dataclass
+class StackRun:
+    configuration: WorkbookConfiguration
+    subscription: SubscriptionInfo
+    storage_url: str
+    storage_key: str
+    storage_account_name: str
+    container_name: str
+    workspace: "pulumi.automation.LocalWorkspace"
+
+# Outcome of a preview or up for one stack
+@dataclasses.dataclass
+class StackResult:
+    stack_name: str
+    operation: str
+    changes: dict = dataclasses.field(default_factory=dict)
+    seconds: float = 0.0
+    stdout: str = ""
+    stderr: str = ""
+    skipped: bool = False
+    error: Exception = None
+    snapshot: BlobUploadResult = None
+
+def prepare_stack(configuration):
+    templates, subscription, subscription_slug, pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container =\
+        validate_resources(configuration)
+    storage_url, storage_key, workspace = ensure_pulumi_resources(subscription.subscription_id,
+        pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container, configuration.stack_name)
+    return StackRun(configuration, subscription, storage_url, storage_key, pulumi_storage_account, pulumi_container, workspace)
+
+def select_stack(stack_run):
+    # The stack manifest can outlive the stack (or its whole container) if it
+    # is deleted behind our back. If selecting fails, check the backend again,
+    # recreating what's missing, and retry once.
+    from pulumi.automation import CommandError, Stack
+    stack_name = stack_run.configuration.stack_name
+    try:
+        return Stack.select(stack_name, stack_run.workspace)
+    except CommandError:
+        print(f"--Unable to select Pulumi stack '{stack_name}' - checking the backend again")
+        blob_service_client = get_client_pool().blob_service_client(stack_run.storage_url, stack_run.storage_key)
+        ensure_pulumi_stack(blob_service_client, stack_run.workspace, stack_run.storage_account_name,
+            stack_run.container_name, stack_name, recheck=True)
+        return Stack.select(stack_name, stack_run.workspace)
+
+def run_stack(stack_run, execute, force=False, services=(), apps=()):
+    configuration = stack_run.configuration
+    result = StackResult(configuration.stack_name, "up" if execute else "preview")
+    started = time.perf_counter()
+    try:
+        # Restrict the run to the selected services/apps, if any
+        targets = stack_targets(configuration, services, apps) if services or apps else None
+
+        # Compare with the configuration recorded by the last successful up
+        model = configuration_model(configuration)
+        previous = download_deployed_model(stack_run.storage_url, stack_run.storage_key,
+            stack_run.container_name, configuration.stack_name)
+        if previous and previous.get("fingerprint") == model["fingerprint"] and not force:
+            print(f"Stack '{configuration.stack_name}' is unchanged since the last update - skipping {result.operation}")
+            result.skipped = True
+            return result
+        if previous:
+            print_deployment_diff(configuration.stack_name, previous.get("deployments", []), model["deployments"])
+        plan = print_expected_changes(configuration)
+
+        stack_run.workspace.program = lambda: deploy_resources (configuration, stack_run.subscription)
+        selected_stack = select_stack(stack_run)
+        if execute:
+            with profiler.phase("pulumi up", stack=configuration.stack_name):
+                up_result = selected_stack.up(target=targets)
+            # Keep a snapshot of the workbook each update was made from
+            snapshot_name = snapshot_blob_name(configuration.stack_name, configuration.file_name, configuration.digest)
+            with profiler.phase("upload workbook snapshot", stack=configuration.stack_name):
+                result.snapshot = upload_file_to_blob(stack_run.storage_url, stack_run.storage_key,
+                    stack_run.container_name, configuration.file_name, snapshot_name)
+            if not targets:
+                # A targeted up leaves the rest of the stack as it was, so it
+                # must not be recorded as deploying the whole workbook
+                upload_deployed_model(stack_run.storage_url, stack_run.storage_key, stack_run.container_name,
+                    configuration.stack_name, model)
+                write_plan(configuration, plan)
+            result.changes = up_result.summary.resource_changes or {}
+            result.stdout, result.stderr = up_result.stdout, up_result.stderr
+        else:
+            with profiler.phase("pulumi preview", stack=configuration.stack_name):
+                preview_result = selected_stack.preview(target=targets)
+            result.changes = preview_result.change_summary or {}
+            result.stdout, result.stderr = preview_result.stdout, preview_result.stderr
+    finally:
+        result.seconds = time.perf_counter() - started
+    return result
+
+def expand_config_files(pattern):
+    # A workbook, a directory of workbooks or a glob pattern
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.xlsx")
+    elif not glob.has_magic(pattern):
+        return [pattern]
+    # Skip the "~$" lock files Excel leaves next to open workbooks
+    return sorted(f for f in glob.glob(pattern) if not os.path.basename(f).startswith("~$"))
+
+def run_stacks(config_files, execute, workers, force=False):
+    results = []
+
+    # Validation and backend bootstrap run in turn - they share the subscription
+    # and backend caches, so only the first workbook for each backend does any work
+    stack_runs = []
+    for config_file in config_files:
+        stack_name = os.path.splitext(os.path.basename(config_file))[0]
+        try:
+            stack_runs.append(prepare_stack(load_configuration(config_file)))
+        except Exception as e:
+            results.append(StackResult(stack_name, "prepare", error=e))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_stack, stack_run, execute, force): stack_run for stack_run in stack_runs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                stack_name = futures[future].configuration.stack_name
+                result = StackResult(stack_name, "up" if execute else "preview", error=e)
+            print(f"..{result.operation} of stack '{result.stack_name}' finished in {result.seconds:.1f}s")
+            results.append(result)
+
+    return sorted(results, key=lambda result: result.stack_name)
+
+# Dry runs: the Pulumi program runs under Pulumi's mock runtime, against stub
+# Azure clients answering from the workbook itself, so nothing leaves the machine
+
+DRY_RUN_ID = "00000000-0000-0000-0000-000000000000"
+
+class StubSubscriptionClient:
+    # Stands in for SubscriptionClient: knows only the workbook's subscription
+    def __init__(self, subscription):
+        self.subscriptions = types.SimpleNamespace(get=lambda subscription_id: subscription,
+            list=lambda: iter([subscription]))
+
+class StubResourceClient:
+    # Stands in for ResourceManagementClient: every resource group the
+    # workbook names exists
+    def __init__(self, resource_group_names):
+        groups = [types.SimpleNamespace(name=name) for name in sorted(resource_group_names)]
+        self.resource_groups = types.SimpleNamespace(list=lambda: iter(groups))
+
+class DryRunClientPool(AzureClientPool):
+    def __init__(self, subscription, resource_group_names):
+        super().__init__()
+        self._subscription_client = StubSubscriptionClient(subscription)
+        self._resource_client = StubResourceClient(resource_group_names)
+
+    def subscription_client(self):
+        return self._subscription_client
+
+    def resource_client(self, subscription_id):
+        return self._resource_client
+
+    def storage_client(self, subscription_id):
+        raise ValueError("Storage accounts can't be managed in a dry run")
+
+    def blob_service_client(self, account_url, account_key, **config):
+        raise ValueError("Blob storage can't be used in a dry run")
+
+def dry_run_mocks():
+    import pulumi
+
+    class DryRunMocks(pulumi.runtime.Mocks):
+        # Records each resource the program declares and answers with its
+        # inputs, plus made-up values for the outputs other resources use
+        def __init__(self):
+            self.resources = []
+            self.declared = set()
+
+        def new_resource(self, args):
+            # Pulumi rejects a repeated URN, so the dry run must too
+            if (args.typ, args.name) in self.declared:
+                raise ValueError(f"{args.typ} '{args.name}' is declared more than once - its URN would not be unique")
+            self.declared.add((args.typ, args.name))
+            self.resources.append({"type": args.typ, "name": args.name, "inputs": dict(args.inputs)})
+            outputs = dict(args.inputs,
+                instrumentationKey=DRY_RUN_ID,
+                vaultUri=f"https://{args.name}.vault.azure.net/",
+                primaryAccessKey="dry-run",
+                identity={"type": "SystemAssigned", "principalId": DRY_RUN_ID})
+            return [f"{args.name}-id", outputs]
+
+        def call(self, args):
+            return {}
+
+    return DryRunMocks()
+
+@profiled("dry_run")
+def dry_run(configuration):
+    # The resources deploy_resources declares for the workbook. Raises
+    # ValueError for anything a real run would reject before calling Azure.
+    import pulumi
+
+    _, subscription_name, *_ = validate_configuration(configuration)
+    deployments = configuration.deployments
+    stub = types.SimpleNamespace(display_name=subscription_name,
+        subscription_id=configuration.config.get('Subscription ID') or DRY_RUN_ID, tenant_id=DRY_RUN_ID)
+    previous_pool = set_client_pool(DryRunClientPool(stub, {deployment['Resource Group'] for deployment in deployments}))
+    try:
+        stub = get_client_pool().subscription_client().subscriptions.get(stub.subscription_id)
+        subscription = SubscriptionInfo(stub.display_name, stub.subscription_id, stub.tenant_id)
+
+        mocks = dry_run_mocks()
+        pulumi.runtime.set_mocks(mocks, project=PULUMI_PROJECT, stack=configuration.stack_name, preview=True)
+        pulumi.runtime.test(lambda: deploy_resources(configuration, subscription))()
+        return mocks.resources
+    finally:
+        set_client_pool(previous_pool)
+
+def print_dry_run(configuration, resources):
+    print(f"Stack '{configuration.stack_name}' declares {len(resources)} resources:")
+    for resource in resources:
+        print(f"  {resource['type']} {resource['name']}")
+
+    # The offline plan should describe exactly what the program declares
+    declared = {(resource["type"], resource["name"]) for resource in resources}
+    planned = {(resource["type"], resource["name"]) for resource in render_plan(configuration)}
+    for resource_type, name in sorted(declared - planned):
+        print(f"--Not in the rendered plan: {resource_type} {name}")
+    for resource_type, name in sorted(planned - declared):
+        print(f"--In the rendered plan but not declared: {resource_type} {name}")
+
+def print_stack_summary(results):
+    print(f"{'Stack':<32} {'Operation':<10} {'Seconds':>8}  Changes")
+    for result in results:
+        if result.error:
+            outcome = f"FAILED: {result.error}"
+        elif result.skipped:
+            outcome = "unchanged - skipped"
+        else:
+            outcome = ", ".join(f"{op}={count}" for op, count in sorted(result.changes.items())) or "no changes"
+            if result.snapshot and not result.snapshot.ok:
+                outcome += f" (workbook snapshot FAILED: {result.snapshot.error})"
+        print(f"{result.stack_name:<32} {result.operation:<10} {result.seconds:>8.1f}  {outcome}")
+
 if __name__ == "__main__":
     import argparse
-    import json
+    import atexit
     import traceback as tb
 
     parser = argparse.ArgumentParser(description="Deploy Azure resources based on an Excel configuration")
-    parser.add_argument("configFile", help="Path to the Excel configuration file")
+    parser.add_argument("configFile", help="Path to the Excel configuration file, or a directory or glob of them to run as a batch")
     parser.add_argument('--pulumi', type=str, help='Pulumi command to run.')
+    parser.add_argument('--plan', action='store_true', default=False, help='Only show the changes expected since the last update, offline from the workbook')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Run the Pulumi program offline against mocks and list the resources it declares')
     parser.add_argument('--execute', action='store_true', default=False, help='Execute pulumi up')
     parser.add_argument('--no-execute', action='store_true', default=False, help='Execute pulumi preview')
+    parser.add_argument('--force', action='store_true', default=False, help='Run Pulumi even if the workbook is unchanged since the last update')
+    parser.add_argument('--service', action='append', default=[], help='Only deploy this service and its apps (may be repeated)')
+    parser.add_argument('--app', action='append', default=[], help='Only deploy this app and what it needs from its service (may be repeated)')
+    parser.add_argument('--profile', type=str, help='Write a timing report of each phase of the run to this file')
+    parser.add_argument('--profile-format', choices=['json', 'otlp'], default='json', help='Timing report format: plain JSON or an OTLP/JSON trace')
+    parser.add_argument('--workers', type=int, default=4, help='Number of stacks to run at once in batch mode')
 
     args = parser.parse_args()
 
-    templates, subscription, subscription_slug, pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container =\
-        validate_resources(args.configFile)
-    stack_name = os.path.splitext(os.path.basename(args.configFile))[0]
-    storage_url, storage_key, initialiser = ensure_pulumi_resources(subscription.subscription_id,
-        pulumi_resource_group, pulumi_storage_account, pulumi_location, pulumi_container, stack_name)
+    if args.profile:
+        profiler.enabled = True
+        atexit.register(profiler.write, args.profile, args.profile_format)
+
+    config_files = expand_config_files(args.configFile)
+    if not config_files:
+        parser.error(f"No workbooks match '{args.configFile}'")
+    if args.plan:
+        # No Pulumi engine and no Azure calls
+        failed = False
+        for config_file in config_files:
+            try:
+                configuration = load_configuration(config_file)
+                validate_resource_names(configuration, configuration.deployments)
+                print_expected_changes(configuration)
+            except ValueError as e:
+                print (f"Error in {config_file}: {e}")
+                failed = True
+        sys.exit(1 if failed else 0)
+    if args.dry_run:
+        failed = False
+        for config_file in config_files:
+            try:
+                configuration = load_configuration(config_file)
+                print_dry_run(configuration, dry_run(configuration))
+            except ValueError as e:
+                print (f"Error in {config_file}: {e}")
+                failed = True
+        sys.exit(1 if failed else 0)
+    if len(config_files) > 1 or config_files[0] != args.configFile:
+        if args.pulumi or args.service or args.app:
+            parser.error("--pulumi, --service and --app need a single configuration workbook")
+        results = run_stacks(config_files, args.execute, args.workers, args.force)
+        print_stack_summary(results)
+        sys.exit(1 if any(result.error or (result.snapshot and not result.snapshot.ok) for result in results) else 0)
+
+    configuration = load_configuration(args.configFile)
+    stack_run = prepare_stack(configuration)
 
     if args.pulumi:
-        send_script_to_pulumi(f"pulumi stack select {stack_name}\npulumi {args.pulumi}", initialiser)
+        run_pulumi_command(stack_run, args.pulumi)
     else:
         try:
-            os.environ ["AZURE_STORAGE_ACCOUNT"] = pulumi_storage_account
-            os.environ ["AZURE_STORAGE_KEY"] = storage_key
-            os.environ ["PULUMI_CONFIG_PASSPHRASE"] ="No secrets here"
-            project_settings=ProjectSettings(
-                name="devops",
-                runtime="python",
-                backend={"url": f"azblob://{pulumi_container}"}
-            )
-            workspace = LocalWorkspace(project_settings=project_settings)
-            selected_stack = select_stack(
-                stack_name=stack_name,
-                program=lambda: deploy_resources (args.configFile),
-                project_name="devops",
-                opts=LocalWorkspaceOptions(project_settings=project_settings)
-            )
-            if args.execute:
-                up_result = selected_stack.up()
-                upload_file_to_blob(storage_url, storage_key, pulumi_container, args.configFile)
-                print(f"update summary: \n{json.dumps(up_result.summary.resource_changes, indent=4)}")
+            result = run_stack(stack_run, args.execute, args.force, args.service, args.app)
+            if args.execute and not result.skipped:
+                print(f"update summary: \n{json.dumps(result.changes, indent=4)}")
             else:
-                up_result = selected_stack.preview()
-                if up_result.stdout:
-                    print (up_result.stdout)
-                if up_result.stderr:
-                    print ("Errors", up_result.stderr) 
+                if result.stdout:
+                    print (result.stdout)
+                if result.stderr:
+                    print ("Errors", result.stderr)
+            if result.snapshot and not result.snapshot.ok:
+                # The update itself succeeded, but there's no record of the workbook it used
+                print (f"Error: the workbook snapshot was not saved: {result.snapshot.error}")
+                sys.exit(1)
 
         except Exception as e:
             if isinstance(e, ValueError):
@@ -460,5 +1710,3 @@ if __name__ == "__main__":
                 print (f"Unexpected error: {e}")
                 tb.print_exc()
         sys.exit(0)
-
-
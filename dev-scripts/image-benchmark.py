@@ -0,0 +1,112 @@
+# Measure the app's container image: its size, how long a rebuild takes after a
+# code-only change (which should reuse the cached dependency layers), and how
+# long a fresh container takes to answer its health check - the part of an
+# App Service restart after a deploy that the image controls.
+#
+#   python dev-scripts/image-benchmark.py --runs 5 --output image.json
+#   python dev-scripts/image-benchmark.py --compare image.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+def docker(*arguments, **kwargs):
+    return subprocess.run(["docker", *arguments], check=True, capture_output=True, text=True, **kwargs).stdout.strip()
+
+def timed_build(tag):
+    started = time.perf_counter()
+    docker("build", "--tag", tag, APP_DIRECTORY)
+    return time.perf_counter() - started
+
+def code_change_build(tag):
+    # Rebuild as if app.py had been edited: only the source layers should rerun
+    path = os.path.join(APP_DIRECTORY, "app.py")
+    with open(path) as f:
+        source = f.read()
+    try:
+        with open(path, "w") as f:
+            f.write(source + "\n# image-benchmark\n")
+        return timed_build(tag)
+    finally:
+        with open(path, "w") as f:
+            f.write(source)
+
+def image_size(tag):
+    return int(docker("image", "inspect", "--format", "{{.Size}}", tag))
+
+def cold_start(tag, port, timeout):
+    # Seconds from `docker run` until /healthz answers 200
+    started = time.perf_counter()
+    container = docker("run", "--detach", "--rm", "--publish", f"{port}:8000", tag)
+    try:
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(f"http://localhost:{port}/healthz", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError(f"The container did not become healthy within {timeout}s")
+    finally:
+        subprocess.run(["docker", "stop", "--time", "1", container], capture_output=True)
+
+def git_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def print_comparison(previous, current):
+    print(f"Compared with {previous.get('commit')} ({previous.get('timestamp')}):")
+    for key, label in (("size_bytes", "size"), ("rebuild_seconds", "rebuild after a code change"),
+                       ("cold_start_median_seconds", "cold start (median)")):
+        if previous.get(key) and current.get(key):
+            print(f"  {label:<28} {(current[key] / previous[key] - 1) * 100:+6.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the app container image's size, rebuild time and cold start.")
+    parser.add_argument("--tag", type=str, default="azureappservice-app:benchmark", help="Tag for the image built. Defaults to azureappservice-app:benchmark.")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts to measure. Defaults to 5.")
+    parser.add_argument("--port", type=int, default=18000, help="Local port for the containers. Defaults to 18000.")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a container to become healthy. Defaults to 60.")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("--compare", type=str, help="A previous results file to compare against.")
+
+    args = parser.parse_args()
+
+    build_seconds = timed_build(args.tag)
+    rebuild_seconds = code_change_build(args.tag)
+    size = image_size(args.tag)
+    print(f"Build {build_seconds:.1f}s, rebuild after a code change {rebuild_seconds:.1f}s, image {size / 1024 / 1024:.1f} MiB")
+
+    starts = [cold_start(args.tag, args.port, args.timeout) for _ in range(args.runs)]
+    print(f"Cold start to healthy: median {statistics.median(starts):.2f}s (min {min(starts):.2f}s, max {max(starts):.2f}s)")
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "tag": args.tag,
+        "size_bytes": size,
+        "build_seconds": build_seconds,
+        "rebuild_seconds": rebuild_seconds,
+        "cold_start_seconds": starts,
+        "cold_start_median_seconds": statistics.median(starts),
+    }
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to {args.output}")
+
+    sys.exit(0)
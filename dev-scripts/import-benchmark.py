@@ -0,0 +1,95 @@
+# Measure how long azure-devops.py takes to start for lightweight commands,
+# in the style of `python -X importtime`, and fail if it exceeds a budget or
+# if any of the heavy SDKs that should be imported lazily are loaded.
+#
+#   python dev-scripts/import-benchmark.py [--runs 5] [--budget 1.0] [--output results.json]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "azure-devops.py")
+
+# Modules that must not be imported just to parse the command line
+HEAVY_MODULES = ("pulumi_azure", "pulumi", "openpyxl", "azure.identity", "azure.mgmt", "azure.storage")
+
+# Only commands that run offline without a workbook. The --pulumi passthrough
+# (e.g. --pulumi "stack ls") is not covered: it reads the workbook, resolves the
+# subscription and the Pulumi backend's storage key from Azure, and drives the
+# Pulumi CLI, so it needs openpyxl, azure.identity, azure.mgmt and
+# pulumi.automation by design, and its time is dominated by those round-trips
+# rather than by imports. Use --profile on a real run to see where it goes.
+COMMANDS = {
+    "help": ["--help"],
+}
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package" lines; top-level
+    # imports are the ones whose package name is not indented
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        if not package.startswith("  "):
+            modules[package.strip()] = int(cumulative)
+    return modules
+
+def run_once(arguments):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", SCRIPT, *arguments],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.perf_counter() - started
+    return seconds, parse_importtime(result.stderr)
+
+def benchmark(name, arguments, runs):
+    timings = []
+    modules = {}
+    for _ in range(runs):
+        seconds, modules = run_once(arguments)
+        timings.append(seconds)
+    heavy = sorted(module for module in modules
+        if any(module == heavy or module.startswith(heavy + ".") for heavy in HEAVY_MODULES))
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        "command": name,
+        "runs": runs,
+        "median_seconds": statistics.median(timings),
+        "min_seconds": min(timings),
+        "max_seconds": max(timings),
+        "heavy_modules": heavy,
+        "slowest_imports_us": dict(slowest),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark azure-devops.py start-up time against a budget.")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per command. Defaults to 5.")
+    parser.add_argument("--budget", type=float, default=1.0, help="Maximum median start-up time in seconds. Defaults to 1.0.")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file.")
+
+    args = parser.parse_args()
+
+    failures = []
+    results = []
+    for name, arguments in COMMANDS.items():
+        result = benchmark(name, arguments, args.runs)
+        results.append(result)
+        print(f"{name}: median {result['median_seconds']:.3f}s (min {result['min_seconds']:.3f}s, max {result['max_seconds']:.3f}s)")
+        for module, microseconds in result["slowest_imports_us"].items():
+            print(f"  {microseconds / 1000:8.1f} ms  {module}")
+        if result["median_seconds"] > args.budget:
+            failures.append(f"{name} took {result['median_seconds']:.3f}s, over the {args.budget:.3f}s budget")
+        if result["heavy_modules"]:
+            failures.append(f"{name} imported {', '.join(result['heavy_modules'])}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"budget_seconds": args.budget, "results": results}, f, indent=4)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
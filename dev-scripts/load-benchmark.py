@@ -0,0 +1,213 @@
+# Load-test the app container and suggest the smallest App Service plan sku
+# that should carry a target load.
+#
+# Runs a fixed-duration, closed-loop load at each concurrency level against the
+# app (by default the local docker-compose service, started in production
+# mode), and reports throughput and p50/p95/p99 latency. Results are written
+# to a JSON file that can be compared with a previous run:
+#
+#   python dev-scripts/load-benchmark.py --compose --target-rps 200 --output load.json
+#   python dev-scripts/load-benchmark.py --compare load.json
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+# Linux App Service plans from cheapest up: (sku, vCPUs, ACU per vCPU). ACU is
+# Azure's compute unit, where 100 is roughly one core of the reference machine.
+APP_SERVICE_SKUS = [
+    ("B1", 1, 100),
+    ("B2", 2, 100),
+    ("B3", 4, 100),
+    ("P0v3", 1, 195),
+    ("P1v3", 2, 195),
+    ("P2v3", 4, 195),
+    ("P3v3", 8, 195),
+]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def worker(url, deadline, latencies, errors, lock):
+    # One client connection, kept alive, sending requests back to back
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    connection = None
+    reused = False
+    local_latencies = []
+    local_errors = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = connection_class(parsed.netloc, timeout=30)
+                reused = False
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            reused = True
+            if response.status >= 500:
+                local_errors += 1
+            else:
+                local_latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException):
+            # The server may close a kept-alive connection (e.g. when a worker
+            # is recycled); that is only an error on a fresh connection
+            if not reused:
+                local_errors += 1
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+    with lock:
+        latencies.extend(local_latencies)
+        errors[0] += local_errors
+
+def run_level(url, concurrency, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + duration
+    threads = [threading.Thread(target=worker, args=(url, deadline, latencies, errors, lock)) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else None,
+    }
+
+def recommend_sku(results, local_cores, local_acu, target_rps, p95_budget_ms):
+    # Best throughput among the levels that met the latency budget, scaled to
+    # ACU so it can be compared with the plans' capacity
+    usable = [r for r in results if r["p95_ms"] is not None and r["p95_ms"] <= p95_budget_ms and not r["errors"]]
+    if not usable:
+        return None, None
+    best = max(usable, key=lambda r: r["throughput_rps"])
+    rps_per_acu = best["throughput_rps"] / (local_cores * local_acu)
+    for sku, vcpus, acu in APP_SERVICE_SKUS:
+        if vcpus * acu * rps_per_acu >= target_rps:
+            return sku, rps_per_acu
+    return APP_SERVICE_SKUS[-1][0] + " (scaled out)", rps_per_acu
+
+def wait_until_healthy(url, timeout):
+    health_url = urllib.parse.urljoin(url, "/healthz")
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(health_url, timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{health_url} did not become healthy within {timeout}s")
+
+def git_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def print_comparison(previous, current):
+    before = {r["concurrency"]: r for r in previous["levels"]}
+    print(f"Compared with {previous.get('commit')} ({previous.get('timestamp')}):")
+    for level in current["levels"]:
+        old = before.get(level["concurrency"])
+        if not old or not old["requests"] or not level["requests"]:
+            continue
+        rps_change = (level["throughput_rps"] / old["throughput_rps"] - 1) * 100
+        p95_change = (level["p95_ms"] / old["p95_ms"] - 1) * 100
+        print(f"  c={level['concurrency']:<4} throughput {rps_change:+6.1f}%  p95 {p95_change:+6.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the app container and recommend an App Service plan sku.")
+    parser.add_argument("--url", type=str, default="http://localhost:8000/", help="URL to load. Defaults to the local docker-compose service.")
+    parser.add_argument("--concurrency", type=str, default="1,4,16,64", help="Comma-separated concurrency levels. Defaults to 1,4,16,64.")
+    parser.add_argument("--duration", type=float, default=15, help="Seconds to run each level. Defaults to 15.")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of unmeasured load before the first level. Defaults to 2.")
+    parser.add_argument("--compose", action="store_true", default=False, help="Start the app with docker-compose in production mode for the run, and stop it afterwards.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Cores available to the container under test. Defaults to this machine's.")
+    parser.add_argument("--local-acu", type=int, default=100, help="ACU per local core, for scaling to App Service plans. Defaults to 100.")
+    parser.add_argument("--target-rps", type=float, help="Requests per second the plan must sustain; enables the sku recommendation.")
+    parser.add_argument("--p95-budget-ms", type=float, default=500, help="Highest acceptable p95 latency for a level to count. Defaults to 500.")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("--compare", type=str, help="A previous results file to compare against.")
+
+    args = parser.parse_args()
+
+    if args.compose:
+        subprocess.run(["docker-compose", "up", "-d", "--build"], cwd=APP_DIRECTORY, check=True,
+            env={**os.environ, "APP_MODE": "production"})
+    try:
+        if args.compose:
+            wait_until_healthy(args.url, 120)
+        if args.warmup:
+            run_level(args.url, 4, args.warmup)
+
+        levels = []
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            level = run_level(args.url, concurrency, args.duration)
+            levels.append(level)
+            if level["requests"]:
+                print(f"c={concurrency:<4} {level['throughput_rps']:9.1f} req/s  p50 {level['p50_ms']:7.1f} ms  "
+                      f"p95 {level['p95_ms']:7.1f} ms  p99 {level['p99_ms']:7.1f} ms  errors {level['errors']}")
+            else:
+                print(f"c={concurrency:<4} no successful requests ({level['errors']} errors)")
+    finally:
+        if args.compose:
+            subprocess.run(["docker-compose", "down"], cwd=APP_DIRECTORY)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "url": args.url,
+        "cores": args.cores,
+        "duration_seconds": args.duration,
+        "levels": levels,
+    }
+
+    if args.target_rps:
+        sku, rps_per_acu = recommend_sku(levels, args.cores, args.local_acu, args.target_rps, args.p95_budget_ms)
+        results["recommendation"] = {"target_rps": args.target_rps, "p95_budget_ms": args.p95_budget_ms,
+            "rps_per_acu": rps_per_acu, "sku": sku}
+        if sku:
+            print(f"Recommended sku for {args.target_rps:g} req/s: {sku} (put this in the Deployments sheet 'sku' column)")
+        else:
+            print(f"No concurrency level met the {args.p95_budget_ms:g} ms p95 budget without errors - no sku recommended")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to {args.output}")
+
+    sys.exit(0)
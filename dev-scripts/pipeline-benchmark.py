@@ -0,0 +1,178 @@
+# Benchmark how the phases of azure-devops.py scale with the size of the
+# configuration workbook, entirely offline.
+#
+# Synthetic workbooks shaped like template-config.xlsx are generated with 10 to
+# 10,000 Deployments rows (a service row followed by its apps, repeated), then
+# each phase is timed: reading the sheets, load_configuration, validation,
+# rendering the plan and building the Pulumi program under mocks (the same
+# path as --dry-run). Results can be saved and compared with a previous run,
+# failing if any phase got slower than allowed:
+#
+#   python dev-scripts/pipeline-benchmark.py --output pipeline.json
+#   python dev-scripts/pipeline-benchmark.py --compare pipeline.json --max-regression 25
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "azure-devops.py")
+
+# Unique names for every service, so large workbooks pass name validation and
+# build under the dry-run mocks, which reject duplicate resources
+TEMPLATES = {
+    "file_share": "files-{Service}",
+}
+
+def load_devops():
+    # azure-devops.py isn't importable by name
+    spec = importlib.util.spec_from_file_location("azure_devops", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_workbook(path, rows, apps_per_service):
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    configuration = workbook.create_sheet("Configuration")
+    for row in (("Subscription", "Benchmark subscription"), ("Subscription slug", "bm"),
+                ("Pulumi Resource Group", "rg-pulumi-bm"), ("Pulumi Storage Account", "stpulumibm")):
+        configuration.append(row)
+    templates = workbook.create_sheet("Templates")
+    for row in TEMPLATES.items():
+        templates.append(row)
+    deployments = workbook.create_sheet("Deployments")
+    deployments.append(("Defines", "Resource Group", "Service", "App", "Region", "sku", "Files quota", "Status"))
+    service = 0
+    app = 0
+    for i in range(rows):
+        if i % (apps_per_service + 1) == 0:
+            service += 1
+            deployments.append(("Service", f"rg-bm-{service % 10}", f"svc{service:05}", None, "uksouth", "B1", 50, None))
+        else:
+            app += 1
+            deployments.append(("app", f"rg-bm-{service % 10}", f"svc{service:05}", f"app{app:05}", None, None, None,
+                "stopped" if app % 7 == 0 else "running"))
+    workbook.save(path)
+
+def timed(function, repeat):
+    # Median seconds over the runs, with the script's own printing silenced
+    timings = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+def read_sheets(devops, path):
+    import openpyxl
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        config = devops.worksheet_to_dict(workbook["Configuration"])
+        devops.worksheet_to_dict(workbook["Templates"])
+        return devops.read_deployments(workbook["Deployments"], config["Subscription slug"])
+    finally:
+        workbook.close()
+
+def load_uncached(devops, path):
+    devops._workbook_cache.clear()
+    return devops.load_configuration(path)
+
+def benchmark(devops, path, rows, repeat, program_rows):
+    phases = {}
+    phases["read_sheets"], _ = timed(lambda: read_sheets(devops, path), repeat)
+    phases["load_configuration"], configuration = timed(lambda: load_uncached(devops, path), repeat)
+    # Rows are typed and checked while the sheets are read, so there's no
+    # separate preparation phase
+    phases["validate_resource_names"], _ = timed(lambda: devops.validate_resource_names(configuration, configuration.deployments), repeat)
+    phases["render_plan"], plan = timed(lambda: devops.render_plan(configuration), repeat)
+    resources = None
+    if rows <= program_rows:
+        # Building the program under mocks is by far the slowest phase; time it once
+        phases["deploy_resources"], declared = timed(lambda: devops.dry_run(configuration), 1)
+        resources = len(declared)
+    return {"rows": rows, "planned_resources": len(plan), "declared_resources": resources, "phases_seconds": phases}
+
+def git_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def compare(previous, current, max_regression, min_seconds):
+    # Phases slower than the previous run by more than max_regression percent;
+    # phases quicker than min_seconds are too noisy to fail on
+    before = {r["rows"]: r for r in previous["results"]}
+    print(f"Compared with {previous.get('commit')} ({previous.get('timestamp')}):")
+    regressions = []
+    for result in current["results"]:
+        old = before.get(result["rows"])
+        if not old:
+            continue
+        for phase, seconds in result["phases_seconds"].items():
+            old_seconds = old["phases_seconds"].get(phase)
+            if not old_seconds:
+                continue
+            change = (seconds / old_seconds - 1) * 100
+            print(f"  rows={result['rows']:<6} {phase:<24} {change:+7.1f}%")
+            if change > max_regression and seconds >= min_seconds:
+                regressions.append(f"{phase} with {result['rows']} rows is {change:.0f}% slower")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark azure-devops.py's parse, validation and program-build phases on synthetic workbooks.")
+    parser.add_argument("--rows", type=str, default="10,100,1000,10000", help="Comma-separated Deployments row counts. Defaults to 10,100,1000,10000.")
+    parser.add_argument("--apps-per-service", type=int, default=4, help="App rows after each service row. Defaults to 4.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each phase; the median is reported. Defaults to 3.")
+    parser.add_argument("--program-rows", type=int, default=1000, help="Largest workbook to build the Pulumi program for. Defaults to 1000.")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("--compare", type=str, help="A previous results file to compare against.")
+    parser.add_argument("--max-regression", type=float, default=25, help="Fail if a phase is more than this percent slower than in --compare. Defaults to 25.")
+    parser.add_argument("--min-ms", type=float, default=5, help="Ignore regressions in phases taking less than this. Defaults to 5.")
+
+    args = parser.parse_args()
+
+    # Keep the benchmark's plan and subscription caches away from the real ones
+    os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="pipeline-benchmark-")
+    devops = load_devops()
+    # Import the Pulumi SDKs up front so the first workbook's program build
+    # doesn't carry their import time (import-benchmark.py measures that)
+    import pulumi
+    import pulumi_azure
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in (int(r) for r in args.rows.split(",")):
+            path = os.path.join(directory, f"bench-{rows}.xlsx")
+            write_workbook(path, rows, args.apps_per_service)
+            result = benchmark(devops, path, rows, args.repeat, args.program_rows)
+            results.append(result)
+            print(f"rows={rows:<6} " + "  ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in result["phases_seconds"].items()))
+
+    current = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "apps_per_service": args.apps_per_service,
+        "results": results,
+    }
+
+    failures = []
+    if args.compare:
+        with open(args.compare) as f:
+            failures = compare(json.load(f), current, args.max_regression, args.min_ms / 1000)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=4)
+        print(f"Results written to {args.output}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
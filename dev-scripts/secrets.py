@@ -1,75 +1,302 @@
-import argparse
-import os
-import re
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
-
-def camel_to_snake_case(name):
-    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
-    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).upper()
-
-def snake_to_camel_case(name):
-    components = name.split('_')
-    return components[0] + ''.join(x.title() for x in components[1:])
-
-def fetch_secrets_from_keyvault(keyvault_name):
-    credential = DefaultAzureCredential()
-    keyvault_url = f"https://{keyvault_name}.vault.azure.net"
-    secret_client = SecretClient(vault_url=keyvault_url, credential=credential)
-
-    secrets = {}
-    for secret_properties in secret_client.list_properties_of_secrets():
-        secret = secret_client.get_secret(secret_properties.name)
-        snake_case_name = camel_to_snake_case(secret.name)
-        secrets[snake_case_name] = secret.value
-
-    return secrets
-
-def upload_secrets_to_keyvault(keyvault_name, secrets):
-    credential = DefaultAzureCredential()
-    keyvault_url = f"https://{keyvault_name}.vault.azure.net"
-    secret_client = SecretClient(vault_url=keyvault_url, credential=credential)
-
-    for key, value in secrets.items():
-        camel_case_name = snake_to_camel_case(key)
-        secret_client.set_secret(camel_case_name, value)
-
-def read_from_file(input_file_path):
-    secrets = {}
-    with open(input_file_path, 'r') as f:
-        for line in f:
-            if '=' in line:
-                key, value = line.strip().split('=', 1)
-                secrets[key] = value
-    return secrets
-
-def write_to_file(secrets, output_file_path, file_format):
-    prefix = "export " if file_format == "export" else ""
-    with open(output_file_path, 'w') as f:
-        for key, value in secrets.items():
-            f.write(f"{prefix}{key}={value}\n")
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='This script interacts with Azure Key Vault to either fetch secrets and write them to an output file or read secrets from an input file and upload them to the Key Vault.'
-    )
-    parser.add_argument('keyvault_name', type=str, help='Name of the Azure Key Vault to interact with.')
-    parser.add_argument('--mode', type=str, choices=['fetch', 'upload'], default='fetch', help='Mode of operation: "fetch" to get secrets from Key Vault, "upload" to upload secrets to Key Vault. Defaults to "fetch".')
-    parser.add_argument('--file', type=str, help='Path of the .env file for fetching or uploading secrets. Required for "upload" mode.')
-    parser.add_argument('--format', type=str, choices=['env', 'export'], default='env', help='Format of the output file when fetching secrets. "env" for .env format and "export" for shell script. Defaults to "env".')
-
-    args = parser.parse_args()
-
-    if args.mode == 'fetch':
-        if not args.file:
-            args.file = ".env" if args.format == "env" else "env.sh"
-        secrets = fetch_secrets_from_keyvault(args.keyvault_name)
-        write_to_file(secrets, args.file, args.format)
-        print(f"Fetched secrets from Key Vault '{args.keyvault_name}' and written to {args.file}")
-
-    elif args.mode == 'upload':
-        if not args.file:
-            raise ValueError("Input file path is required in upload mode.")
-        secrets = read_from_file(args.file)
-        upload_secrets_to_keyvault(args.keyvault_name, secrets)
-        print(f"Uploaded secrets from {args.file} to Key Vault '{args.keyvault_name}'")
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from azure.core.exceptions import HttpResponseError
+from azure.identity import DefaultAzureCredential
+from azure.keyvault.secrets import SecretClient
+
+# Key Vault answers 429 when a vault is throttled; 503 is sometimes returned too
+THROTTLED_STATUS_CODES = (429, 503)
+# Other server errors worth retrying, without treating them as throttling
+TRANSIENT_STATUS_CODES = (500, 502, 504)
+MAX_RETRIES = 6
+
+def camel_to_snake_case(name):
+    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
+    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).upper()
+
+def snake_to_camel_case(name):
+    components = name.split('_')
+    return components[0] + ''.join(x.title() for x in components[1:])
+
+class AdaptiveLimiter:
+    """
+    Bounds the number of Key Vault calls in flight. The limit halves whenever
+    the vault throttles us and creeps back up by one after a run of successes.
+    """
+    def __init__(self, max_concurrency, increase_after=10):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.increase_after = increase_after
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *args):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def throttled(self):
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+    def succeeded(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+def retry_after(error, attempt):
+    # Honour the vault's Retry-After header, else back off exponentially with jitter
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return min(30, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def call_with_backoff(limiter, operation, *args):
+    # Run operation(*args) under the limiter, retrying if the vault throttles it
+    # or fails with a transient server error
+    for attempt in range(MAX_RETRIES + 1):
+        with limiter:
+            try:
+                result = operation(*args)
+            except HttpResponseError as e:
+                retryable = THROTTLED_STATUS_CODES + TRANSIENT_STATUS_CODES
+                if e.status_code not in retryable or attempt == MAX_RETRIES:
+                    raise
+                error = e
+            else:
+                limiter.succeeded()
+                return result
+        if error.status_code in THROTTLED_STATUS_CODES:
+            limiter.throttled()
+        time.sleep(retry_after(error, attempt))
+
+def list_secret_properties(limiter, secret_client):
+    # The listing is paged lazily, so read every page inside call_with_backoff;
+    # a throttled page restarts the listing
+    return call_with_backoff(limiter, lambda: list(secret_client.list_properties_of_secrets()))
+
+def keyvault_client(keyvault_name):
+    credential = DefaultAzureCredential()
+    keyvault_url = f"https://{keyvault_name}.vault.azure.net"
+    # The SDK still retries connection and read failures, but error responses
+    # are retried by call_with_backoff, so throttling can reduce concurrency
+    return SecretClient(vault_url=keyvault_url, credential=credential, retry_status=0)
+
+def secret_hash(name, value):
+    return hashlib.sha256(f"{name.lower()}\n{value}".encode("utf-8")).hexdigest()
+
+def manifest_path(keyvault_name):
+    # Same cache directory as azure-devops.py
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_root, "azure-devops", f"secrets-{keyvault_name}.json")
+
+def read_manifest(keyvault_name):
+    """
+    The local record of each secret's value hash, keyed by lower-case name,
+    along with the secret's updated time in the vault when the hash was taken.
+    The hashes never leave this machine.
+    """
+    try:
+        with open(manifest_path(keyvault_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(keyvault_name, manifest):
+    path = manifest_path(keyvault_name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+            os.chmod(f.name, 0o600)
+            json.dump(manifest, f, indent=2)
+        os.replace(f.name, path)
+    except OSError as e:
+        print(f"--Unable to write secrets manifest {path}: {e}")
+
+def manifest_entry(properties, value):
+    # The vault's updated time identifies the version the hash was taken from
+    updated_on = properties.updated_on.isoformat() if properties.updated_on else None
+    return {"updated": updated_on, "sha256": secret_hash(properties.name, value)}
+
+def manifest_hash(manifest, properties):
+    # The recorded hash, if the secret hasn't been updated in the vault since
+    entry = manifest.get(properties.name.lower())
+    updated_on = properties.updated_on.isoformat() if properties.updated_on else None
+    if entry and updated_on and entry.get("updated") == updated_on:
+        return entry.get("sha256")
+    return None
+
+def fetch_secrets_from_keyvault(keyvault_name, concurrency=8, secret_client=None):
+    """
+    Fetch every enabled secret in the vault, with up to `concurrency`
+    get_secret calls in flight. Pass `secret_client` to use a stand-in for a
+    real vault.
+    """
+    secret_client = secret_client or keyvault_client(keyvault_name)
+    limiter = AdaptiveLimiter(concurrency)
+
+    # Disabled secrets (e.g. after sync --disable-removed) can't be read
+    names = [secret_properties.name for secret_properties in list_secret_properties(limiter, secret_client)
+             if secret_properties.enabled is not False]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.max_concurrency) as executor:
+        fetched = executor.map(lambda name: call_with_backoff(limiter, secret_client.get_secret, name), names)
+        secrets = {}
+        for secret in fetched:
+            snake_case_name = camel_to_snake_case(secret.name)
+            secrets[snake_case_name] = secret.value
+
+    return secrets
+
+def upload_secrets_to_keyvault(keyvault_name, secrets, concurrency=8, secret_client=None):
+    """
+    Set every secret in the vault, with up to `concurrency` set_secret calls
+    in flight. Pass `secret_client` to use a stand-in for a real vault.
+    """
+    secret_client = secret_client or keyvault_client(keyvault_name)
+    limiter = AdaptiveLimiter(concurrency)
+    manifest = read_manifest(keyvault_name)
+
+    def upload(item):
+        key, value = item
+        camel_case_name = snake_to_camel_case(key)
+        secret = call_with_backoff(limiter, secret_client.set_secret, camel_case_name, value)
+        manifest[camel_case_name.lower()] = manifest_entry(secret.properties, value)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.max_concurrency) as executor:
+        list(executor.map(upload, secrets.items()))
+    write_manifest(keyvault_name, manifest)
+
+def sync_secrets_to_keyvault(keyvault_name, secrets, disable_removed=False, concurrency=8, secret_client=None):
+    """
+    Upload only the secrets that are new or have changed, so unchanged secrets
+    don't gain a new version. Changes are detected against a local manifest of
+    value hashes, which is valid for as long as a secret's updated time in the
+    vault matches the one recorded; other secrets have their values fetched.
+    Secrets missing from `secrets` are disabled if `disable_removed` is set.
+
+    Returns the (added, changed, removed) secret names.
+    """
+    secret_client = secret_client or keyvault_client(keyvault_name)
+    limiter = AdaptiveLimiter(concurrency)
+    manifest = read_manifest(keyvault_name)
+
+    # Key Vault secret names are case-insensitive
+    local = {snake_to_camel_case(key): value for key, value in secrets.items()}
+    local_names = {name.lower() for name in local}
+    vault = {properties.name.lower(): properties for properties in list_secret_properties(limiter, secret_client)}
+
+    def is_changed(name):
+        properties = vault[name.lower()]
+        if not properties.enabled:
+            return True
+        stored_hash = manifest_hash(manifest, properties)
+        if stored_hash is None:
+            # Set elsewhere, or not seen from here before - compare the value itself
+            if call_with_backoff(limiter, secret_client.get_secret, properties.name).value != local[name]:
+                return True
+            stored_hash = secret_hash(properties.name, local[name])
+        if stored_hash != secret_hash(properties.name, local[name]):
+            return True
+        manifest[name.lower()] = manifest_entry(properties, local[name])
+        return False
+
+    existing = [name for name in local if name.lower() in vault]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.max_concurrency) as executor:
+        changed = [name for name, differs in zip(existing, executor.map(is_changed, existing)) if differs]
+        added = [name for name in local if name.lower() not in vault]
+        removed = [properties.name for key, properties in vault.items() if key not in local_names and properties.enabled]
+
+        def upload(name):
+            properties = vault.get(name.lower())
+            tags = properties.tags if properties else None
+            secret = call_with_backoff(limiter, lambda: secret_client.set_secret(name, local[name], tags=tags))
+            manifest[name.lower()] = manifest_entry(secret.properties, local[name])
+
+        def disable(name):
+            call_with_backoff(limiter, lambda: secret_client.update_secret_properties(name, enabled=False))
+            manifest.pop(name.lower(), None)
+
+        list(executor.map(upload, added + changed))
+        if disable_removed:
+            list(executor.map(disable, removed))
+
+    write_manifest(keyvault_name, manifest)
+
+    for label, names in (("Added", added), ("Changed", changed),
+            ("Disabled" if disable_removed else "Only in vault", removed)):
+        for name in sorted(names):
+            print(f"{label}: {name}")
+    print(f"{len(added)} added, {len(changed)} changed, {len(local) - len(added) - len(changed)} unchanged, "
+          f"{len(removed)} {'disabled' if disable_removed else 'only in the vault'}")
+
+    return added, changed, removed
+
+def read_from_file(input_file_path):
+    secrets = {}
+    with open(input_file_path, 'r') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.strip().split('=', 1)
+                secrets[key] = value
+    return secrets
+
+def write_to_file(secrets, output_file_path, file_format):
+    prefix = "export " if file_format == "export" else ""
+    with open(output_file_path, 'w') as f:
+        for key, value in secrets.items():
+            f.write(f"{prefix}{key}={value}\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='This script interacts with Azure Key Vault to either fetch secrets and write them to an output file or read secrets from an input file and upload them to the Key Vault.'
+    )
+    parser.add_argument('keyvault_name', type=str, help='Name of the Azure Key Vault to interact with.')
+    parser.add_argument('--mode', type=str, choices=['fetch', 'upload', 'sync'], default='fetch', help='Mode of operation: "fetch" to get secrets from Key Vault, "upload" to upload secrets to Key Vault, "sync" to upload only new or changed secrets. Defaults to "fetch".')
+    parser.add_argument('--file', type=str, help='Path of the .env file for fetching or uploading secrets. Required for "upload" and "sync" modes.')
+    parser.add_argument('--disable-removed', action='store_true', default=False, help='In "sync" mode, disable vault secrets that are no longer in the file.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Maximum number of Key Vault requests in flight. Reduced automatically if the vault throttles. Defaults to 8.')
+    parser.add_argument('--format', type=str, choices=['env', 'export'], default='env', help='Format of the output file when fetching secrets. "env" for .env format and "export" for shell script. Defaults to "env".')
+
+    args = parser.parse_args()
+
+    if args.mode == 'fetch':
+        if not args.file:
+            args.file = ".env" if args.format == "env" else "env.sh"
+        secrets = fetch_secrets_from_keyvault(args.keyvault_name, args.concurrency)
+        write_to_file(secrets, args.file, args.format)
+        print(f"Fetched secrets from Key Vault '{args.keyvault_name}' and written to {args.file}")
+
+    elif args.mode == 'upload':
+        if not args.file:
+            raise ValueError("Input file path is required in upload mode.")
+        secrets = read_from_file(args.file)
+        upload_secrets_to_keyvault(args.keyvault_name, secrets, args.concurrency)
+        print(f"Uploaded secrets from {args.file} to Key Vault '{args.keyvault_name}'")
+
+    elif args.mode == 'sync':
+        if not args.file:
+            raise ValueError("Input file path is required in sync mode.")
+        secrets = read_from_file(args.file)
+        sync_secrets_to_keyvault(args.keyvault_name, secrets, args.disable_removed, args.concurrency)
+        print(f"Synchronised secrets from {args.file} to Key Vault '{args.keyvault_name}'")
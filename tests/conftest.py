@@ -0,0 +1,26 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app's modules import each other by bare name, as they do in the container
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+@pytest.fixture(scope="session")
+def devops(tmp_path_factory):
+    # azure-devops.py isn't importable by name. Its caches (plans, stack
+    # manifests) go to a temporary directory rather than ~/.cache.
+    os.environ["XDG_CACHE_HOME"] = str(tmp_path_factory.mktemp("cache"))
+    spec = importlib.util.spec_from_file_location("azure_devops", os.path.join(ROOT, "azure-devops.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def sheet():
+    # A worksheet to append rows to, as read from a workbook
+    import openpyxl
+    return openpyxl.Workbook().active
@@ -0,0 +1,81 @@
+# AzureClientPool against a local mock transport: clients are reused, and every
+# client shares the pool's credential, so one token serves them all.
+
+import json
+import time
+
+from azure.core.credentials import AccessToken
+from azure.core.pipeline.transport import HttpResponse, HttpTransport
+
+class MockResponse(HttpResponse):
+    def __init__(self, request, status_code, body=b""):
+        super().__init__(request, None)
+        self.status_code = status_code
+        self.headers = {"Content-Type": "application/json", "Content-Length": str(len(body))}
+        self._body = body
+
+    def body(self):
+        return self._body
+
+    def read(self):
+        return self._body
+
+    @property
+    def content(self):
+        return self._body
+
+    def json(self):
+        return json.loads(self._body)
+
+class MockTransport(HttpTransport):
+    # Answers HEAD with 204 and anything else with an empty list page
+    def __init__(self):
+        self.requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        if request.method == "HEAD":
+            return MockResponse(request, 204)
+        return MockResponse(request, 200, json.dumps({"value": []}).encode())
+
+class CountingCredential:
+    def __init__(self):
+        self.tokens_issued = 0
+
+    def get_token(self, *scopes, **kwargs):
+        self.tokens_issued += 1
+        return AccessToken(f"token-{self.tokens_issued}", int(time.time()) + 3600)
+
+def test_clients_share_one_token_and_transport(devops):
+    transport = MockTransport()
+    credential = CountingCredential()
+    pool = devops.AzureClientPool(credential=credential, transport=transport)
+
+    resource_client = pool.resource_client("subscription-1")
+    storage_client = pool.storage_client("subscription-1")
+    assert resource_client.resource_groups.check_existence("rg-1")
+    assert list(storage_client.storage_accounts.list_by_resource_group("rg-1")) == []
+
+    assert credential.tokens_issued == 1
+    assert pool.counters == {"tokens_fetched": 1, "requests_sent": 2}
+    assert [request.headers["Authorization"] for request in transport.requests] == ["Bearer token-1"] * 2
+    assert set(pool.http_stats()) == {"ResourceManagementClient", "StorageManagementClient"}
+
+def test_clients_are_reused_per_key(devops):
+    pool = devops.AzureClientPool(credential=CountingCredential(), transport=MockTransport())
+
+    assert pool.resource_client("subscription-1") is pool.resource_client("subscription-1")
+    assert pool.resource_client("subscription-1") is not pool.resource_client("subscription-2")
+    assert pool.storage_client("subscription-1") is pool.storage_client("subscription-1")
@@ -0,0 +1,64 @@
+# dry_run builds the Pulumi program for a workbook under mocks - no Pulumi
+# engine and no calls to Azure - so these run in seconds.
+
+import types
+
+import openpyxl
+import pytest
+
+def write_workbook(path, services, apps_per_service=2, file_share_template="files-{Service}"):
+    workbook = openpyxl.Workbook()
+    configuration = workbook.active
+    configuration.title = "Configuration"
+    for row in (("Subscription", "Test subscription"), ("Subscription slug", "test"),
+                ("Pulumi Resource Group", "rg-pulumi-test"), ("Pulumi Storage Account", "stpulumitest")):
+        configuration.append(row)
+    workbook.create_sheet("Templates").append(("file_share", file_share_template))
+    deployments = workbook.create_sheet("Deployments")
+    deployments.append(("Defines", "Resource Group", "Service", "App", "Files quota"))
+    for service in range(services):
+        deployments.append(("Service", "rg-test", f"svc{service}", None, 50))
+        for app in range(apps_per_service):
+            deployments.append(("app", "rg-test", f"svc{service}", f"app{service}x{app}"))
+    workbook.save(path)
+    return path
+
+def test_declares_what_the_plan_renders(devops, tmp_path):
+    configuration = devops.load_configuration(write_workbook(tmp_path / "multi.xlsx", services=3))
+    declared = devops.dry_run(configuration)
+
+    names = [(resource["type"], resource["name"]) for resource in declared]
+    assert len(names) == len(set(names))
+    assert set(names) == {(resource["type"], resource["name"]) for resource in devops.render_plan(configuration)}
+    # Each service keeps its own copy of the storage secrets
+    secrets = [name for resource_type, name in names if resource_type == devops.SECRET_RESOURCE_TYPE]
+    assert len(secrets) == 3 * len(devops.STORAGE_SECRET_NAMES)
+
+def test_duplicate_names_are_rejected(devops, tmp_path):
+    # Every service's file share would be called "files"
+    configuration = devops.load_configuration(
+        write_workbook(tmp_path / "duplicate.xlsx", services=2, file_share_template="files"))
+    with pytest.raises(ValueError, match="files"):
+        devops.dry_run(configuration)
+
+def test_mocks_reject_a_repeated_resource(devops):
+    mocks = devops.dry_run_mocks()
+    args = types.SimpleNamespace(typ="azure:storage/share:Share", name="files", inputs={})
+    mocks.new_resource(args)
+    with pytest.raises(ValueError, match="declared more than once"):
+        mocks.new_resource(args)
+
+@pytest.mark.parametrize("file_share_template", ["files-{Service}", "files"])
+def test_client_pool_is_restored(devops, tmp_path, file_share_template):
+    configuration = devops.load_configuration(
+        write_workbook(tmp_path / "pool.xlsx", services=2, file_share_template=file_share_template))
+    pool = object()
+    previous = devops.set_client_pool(pool)
+    try:
+        try:
+            devops.dry_run(configuration)
+        except ValueError:
+            pass
+        assert devops.get_client_pool() is pool
+    finally:
+        devops.set_client_pool(previous)
@@ -0,0 +1,74 @@
+# read_deployments: rows are typed and defaulted as the Deployments sheet is
+# read, and every problem in the sheet is reported in one ValueError.
+
+import pytest
+
+HEADERS = ("Defines", "Resource Group", "Service", "App", "Region", "sku", "Files quota", "Status")
+
+def read(devops, sheet, *rows, headers=HEADERS):
+    sheet.append(headers)
+    for row in rows:
+        sheet.append(row)
+    return devops.read_deployments(sheet, "dev")
+
+def test_defaults_and_types(devops, sheet):
+    service, app = read(devops, sheet,
+        ("Service", "rg-one", "Web", None, None, None, None, None),
+        ("App", "rg-one", "Web", "api", "UKWest", "P1v3", 100, "Stopped"))
+
+    assert service.defines == "service"
+    assert service.service == "web"
+    assert service.region == "uksouth"
+    assert service.sku == "B1"
+    assert service.files_quota == 50
+    assert service.status is devops.DeploymentStatus.RUNNING
+    assert service.subscription == "dev"
+
+    assert app.defines == "app"
+    assert app.app == "api"
+    assert app.region == "ukwest"
+    assert app.sku == "P1v3"
+    assert app.files_quota == 100
+    assert app.status is devops.DeploymentStatus.STOPPED
+    # Rows still read like the sheet's dicts, with enum values as their text
+    assert app["Status"] == "stopped"
+    assert app.get("App") == "api"
+
+def test_numeric_cells(devops, sheet):
+    # Excel stores numbers as floats; whole ones read as integers (and text)
+    deployment, = read(devops, sheet, ("service", 2024.0, 7, None, None, None, 25.0, None))
+    assert deployment.resource_group == "2024"
+    assert deployment.service == "7"
+    assert deployment.files_quota == 25
+
+def test_blank_rows_are_skipped(devops, sheet):
+    deployments = read(devops, sheet,
+        (None,) * len(HEADERS),
+        ("service", "rg", "web"),
+        (),
+        (None,) * len(HEADERS),
+        ("app", "rg", "web", "api"))
+    assert [deployment.defines for deployment in deployments] == ["service", "app"]
+
+def test_extra_columns_are_kept(devops, sheet):
+    deployment, = read(devops, sheet, ("service", "rg", "web", "Team A"), headers=("Defines", "Resource Group", "Service", "Owner"))
+    assert deployment["Owner"] == "Team A"
+    assert "Owner" in dict(deployment)
+
+def test_every_problem_is_reported_at_once(devops, sheet):
+    with pytest.raises(ValueError) as error:
+        read(devops, sheet,
+            ("service", None, "web", None, None, None, 2.5, None),
+            ("app", "rg", "web", None, None, None, None, "paused"),
+            ("service", "rg", None, None, None, None, "lots", None))
+    message = str(error.value)
+    assert "'Resource Group' is missing from row 1" in message
+    assert "Row 1: 'Files quota' must be a whole number of GiB, not '2.5'" in message
+    assert "'App' is missing from row 2" in message
+    assert "Row 2: 'Status' must be one of running, stopped, not 'paused'" in message
+    assert "'Service' is missing from row 3" in message
+    assert "Row 3: 'Files quota' must be a whole number of GiB, not 'lots'" in message
+
+def test_app_column_is_only_required_for_apps(devops, sheet):
+    deployment, = read(devops, sheet, ("service", "rg", "web"))
+    assert deployment.app is None
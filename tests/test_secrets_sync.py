@@ -0,0 +1,150 @@
+# dev-scripts/secrets.py against an in-memory stand-in for a Key Vault.
+
+import datetime
+import importlib.util
+import itertools
+import os
+import types
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from conftest import ROOT
+
+@pytest.fixture(scope="module")
+def kvsecrets():
+    # Loaded under another name: "secrets" is a standard library module
+    spec = importlib.util.spec_from_file_location("keyvault_secrets", os.path.join(ROOT, "dev-scripts", "secrets.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    # Each test starts without a manifest
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+class StubVault:
+    # Just enough of SecretClient. Names are case-insensitive, as in Key Vault,
+    # and each write moves the secret's updated time on.
+    def __init__(self, **secrets):
+        self.secrets = {}
+        self.calls = []
+        self._clock = itertools.count(1)
+        for name, value in secrets.items():
+            self._store(name, value, None)
+        self.calls.clear()
+
+    def _store(self, name, value, tags):
+        self.secrets[name.lower()] = {"name": name, "value": value, "enabled": True, "tags": tags,
+                                      "updated_on": self._now()}
+
+    def _now(self):
+        return datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=next(self._clock))
+
+    def _properties(self, secret):
+        return types.SimpleNamespace(name=secret["name"], enabled=secret["enabled"], tags=secret["tags"],
+                                     updated_on=secret["updated_on"])
+
+    def list_properties_of_secrets(self):
+        self.calls.append(("list",))
+        return iter([self._properties(secret) for secret in self.secrets.values()])
+
+    def get_secret(self, name):
+        self.calls.append(("get", name))
+        secret = self.secrets[name.lower()]
+        if not secret["enabled"]:
+            error = HttpResponseError("Operation get is not allowed on a disabled secret")
+            error.status_code = 403
+            raise error
+        return types.SimpleNamespace(name=secret["name"], value=secret["value"], properties=self._properties(secret))
+
+    def set_secret(self, name, value, tags=None):
+        self.calls.append(("set", name))
+        self._store(name, value, tags)
+        secret = self.secrets[name.lower()]
+        return types.SimpleNamespace(name=name, value=value, properties=self._properties(secret))
+
+    def update_secret_properties(self, name, enabled=None, tags=None):
+        self.calls.append(("update", name))
+        secret = self.secrets[name.lower()]
+        if enabled is not None:
+            secret["enabled"] = enabled
+        if tags is not None:
+            secret["tags"] = tags
+        secret["updated_on"] = self._now()
+        return self._properties(secret)
+
+    def calls_of(self, kind):
+        return [call[1] for call in self.calls if call[0] == kind]
+
+def sync(kvsecrets, vault, secrets, **kwargs):
+    vault.calls.clear()
+    return kvsecrets.sync_secrets_to_keyvault("stub", secrets, secret_client=vault, **kwargs)
+
+def test_added_changed_and_unchanged(kvsecrets):
+    vault = StubVault()
+    assert sync(kvsecrets, vault, {"API_KEY": "1", "DB_PASSWORD": "2"}) == (["APIKey", "DBPassword"], [], [])
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1", "DB_PASSWORD": "3"}) == ([], ["DBPassword"], [])
+    # Only the changed secret gains a new version
+    assert vault.calls_of("set") == ["DBPassword"]
+    assert vault.secrets["dbpassword"]["value"] == "3"
+
+def test_unchanged_secrets_are_checked_against_the_manifest(kvsecrets):
+    vault = StubVault()
+    sync(kvsecrets, vault, {"API_KEY": "1", "DB_PASSWORD": "2"})
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1", "DB_PASSWORD": "2"}) == ([], [], [])
+    # Neither value had to be fetched, and nothing was written
+    assert vault.calls == [("list",)]
+    # The hashes stay on this machine - nothing is tagged in the vault
+    assert all(secret["tags"] is None for secret in vault.secrets.values())
+
+def test_secrets_set_elsewhere_are_compared_by_value(kvsecrets):
+    vault = StubVault(apiKey="1", dbPassword="2")
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1", "DB_PASSWORD": "changed"}) == ([], ["DBPassword"], [])
+    assert sorted(vault.calls_of("get")) == ["apiKey", "dbPassword"]
+
+    # Both are in the manifest now, so the next sync fetches neither
+    sync(kvsecrets, vault, {"API_KEY": "1", "DB_PASSWORD": "changed"})
+    assert vault.calls_of("get") == []
+
+def test_a_change_made_in_the_vault_is_noticed(kvsecrets):
+    vault = StubVault()
+    sync(kvsecrets, vault, {"API_KEY": "1"})
+    vault.set_secret("apiKey", "edited in the portal")
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1"}) == ([], ["APIKey"], [])
+    assert vault.calls_of("get") == ["apiKey"]
+    assert vault.secrets["apikey"]["value"] == "1"
+
+def test_names_are_case_insensitive(kvsecrets):
+    vault = StubVault(dbpassword="2")
+    assert sync(kvsecrets, vault, {"DB_PASSWORD": "2"}) == ([], [], [])
+    assert vault.calls_of("set") == []
+
+def test_removed_secrets_are_disabled_only_when_asked(kvsecrets):
+    vault = StubVault(apiKey="1", oldKey="2")
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1"}) == ([], [], ["oldKey"])
+    assert vault.secrets["oldkey"]["enabled"]
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1"}, disable_removed=True) == ([], [], ["oldKey"])
+    assert not vault.secrets["oldkey"]["enabled"]
+
+    # Already disabled, so no longer reported
+    assert sync(kvsecrets, vault, {"API_KEY": "1"}, disable_removed=True) == ([], [], [])
+
+def test_a_disabled_secret_back_in_the_file_is_set_again(kvsecrets):
+    vault = StubVault(apiKey="1")
+    vault.secrets["apikey"]["enabled"] = False
+
+    assert sync(kvsecrets, vault, {"API_KEY": "1"}) == ([], ["APIKey"], [])
+    assert vault.secrets["apikey"]["enabled"]
+
+def test_fetch_skips_disabled_secrets(kvsecrets):
+    vault = StubVault(apiKey="1", oldKey="2")
+    vault.secrets["oldkey"]["enabled"] = False
+    assert kvsecrets.fetch_secrets_from_keyvault("stub", secret_client=vault) == {"API_KEY": "1"}
@@ -0,0 +1,129 @@
+# CachedFileStore over a plain directory standing in for the Azure Files share.
+
+import os
+import threading
+
+import flask
+import pytest
+
+from storage import CachedFileStore, FileStore
+
+def write(directory, name, size, fill=b"x"):
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(fill * size)
+
+def cached_files(cache):
+    return sorted(os.listdir(cache._directory()))
+
+@pytest.fixture
+def share(tmp_path):
+    path = tmp_path / "share"
+    path.mkdir()
+    return str(path)
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / "cache")
+
+def test_least_recently_used_files_are_evicted_by_size(share, cache_dir):
+    for name in ("a", "b", "c"):
+        write(share, name, 400)
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1000)
+
+    cache.fetch("a")
+    cache.fetch("b")
+    cache.fetch("a")
+    cache.fetch("c")
+
+    assert list(cache._entries) == ["a", "c"]
+    assert cache._bytes == 800
+    assert len(cached_files(cache)) == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+
+def test_files_too_big_to_cache_are_served_from_the_share(share, cache_dir):
+    write(share, "big", 2000)
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1000)
+    path, _ = cache.fetch("big")
+    assert path == os.path.join(share, "big")
+    assert cached_files(cache) == []
+
+def test_limit_is_shared_between_processes(share, cache_dir):
+    write(share, "a", 400)
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1000, processes=4)
+    path, _ = cache.fetch("a")
+    # 250 bytes each - too big to cache here
+    assert path == os.path.join(share, "a")
+
+def test_directories_of_exited_processes_are_removed(share, cache_dir):
+    write(share, "a", 10)
+    stale = os.path.join(cache_dir, "999999999")
+    os.makedirs(stale)
+    write(stale, "a.old", 10)
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1000)
+    cache.fetch("a")
+    assert os.listdir(cache_dir) == [str(os.getpid())]
+
+def test_changes_on_the_share_are_seen_after_revalidation(share, cache_dir):
+    write(share, "a", 10, b"1")
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1000, revalidate_after=3600)
+    path, first = cache.fetch("a")
+
+    write(share, "a", 20, b"2")
+    # Not checked against the share again yet
+    assert cache.fetch("a") == (path, first)
+
+    cache.revalidate_after = 0
+    path, second = cache.fetch("a")
+    assert second != first
+    with open(path, "rb") as f:
+        assert f.read() == b"2" * 20
+    assert len(cached_files(cache)) == 1
+
+def test_concurrent_misses_on_one_file(share, cache_dir):
+    write(share, "a", 100_000)
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1_000_000)
+    barrier = threading.Barrier(8)
+    paths = []
+
+    def fetch():
+        barrier.wait()
+        paths.append(cache.fetch("a")[0])
+
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every request got a complete copy, and only one is kept
+    assert len(paths) == 8
+    assert len(cached_files(cache)) == 1
+    assert cache._bytes == 100_000
+    assert os.path.getsize(cache._entries["a"][1]) == 100_000
+
+@pytest.fixture
+def client(share, cache_dir):
+    write(share, "a.txt", 1000)
+    cache = CachedFileStore(FileStore(share), cache_dir, max_bytes=1_000_000)
+    app = flask.Flask(__name__)
+    app.add_url_rule("/files/<path:name>", "files", cache.send)
+    return app.test_client()
+
+def test_send_range_and_conditional_requests(client):
+    response = client.get("/files/a.txt")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get("/files/a.txt", headers={"Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert len(response.data) == 100
+
+    response = client.get("/files/a.txt", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+def test_send_missing_file(client):
+    assert client.get("/files/missing.txt").status_code == 404
+
+def test_names_outside_the_share_are_refused(share):
+    with pytest.raises(ValueError):
+        FileStore(share).path("../secret")